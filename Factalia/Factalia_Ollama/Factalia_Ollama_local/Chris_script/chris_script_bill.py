@@ -1,61 +1,131 @@
 import pdfplumber
-import requests
 import csv
 import os
+import re
+import sys
+import threading
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Funciones comunes a los scripts de Chris y Nando (Ollama, reglas, manifiesto): invoice_common.py,
+# en la carpeta superior
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import invoice_common
+from invoice_common import (
+    query_llama_3, query_fields, clean_and_format_text, get_missing_fields, merge_missing_fields, normalize_text,
+    find_dates, find_invoice_number, find_invoice_date, load_manifest, save_manifest, get_file_fingerprint,
+    needs_processing, dedupe_csv
+)
+
+# Hash, cachés y presupuesto de tokens: factalia_common.py (carpeta Factalia), importable tras invoice_common
+from factalia_common import (
+    text_cache_key, text_cache_get, text_cache_put, file_sha256, fit_prompt, llm_cache_stats, text_cache_stats,
+    token_stats
+)
+
+# Campos que se extraen de cada factura (mismo orden que en el prompt de extracción)
+INVOICE_FIELDS = [
+    'Número de factura',
+    'Razón social del proveedor',
+    'Consumo kWh',
+    'Fecha de emisión de la factura',
+    'Período de facturación'
+]
 
 # Función para extraer el texto de un archivo PDF completo
-def extract_text_from_pdf(pdf_path):
-    text = ""
+# El texto de cada página queda en la caché de texto: al cambiar los prompts no se vuelve a leer el PDF
+# (file_hash evita recalcular el hash si ya se conoce, p. ej. el del manifiesto)
+def extract_text_from_pdf(pdf_path, file_hash=None):
+    cache_key = text_cache_key(file_hash or file_sha256(pdf_path), 'pdfplumber', {'version': pdfplumber.__version__})
+    page_texts = text_cache_get(cache_key)
+    if page_texts is not None:
+        return "".join(page_texts)
+
+    page_texts = []
     with pdfplumber.open(pdf_path) as pdf:
         for page in pdf.pages:
-            text += page.extract_text() or ""
-    return text
-
-# Función para enviar el texto al modelo LLaMA 3 y obtener una respuesta
-def query_llama_3(api_key, api_url, text, prompt):
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "model": "llama3",
-        "prompt": prompt,
-        "stream": False,
-        "max_tokens": 3500
-    }
-    
-    response = requests.post(api_url, headers=headers, json=payload)
-    
-    if response.status_code != 200:
-        print(f"Error: {response.status_code} - {response.text}")
-        return None
-
-    return response.json().get('response', '')
-
-# Función para limpiar y formatear el texto
-def clean_and_format_text(text, prompt):
-    response = query_llama_3(api_key, api_url, text, prompt)
-    return response if response else ""
+            page_texts.append(page.extract_text() or "")
+            page.flush_cache()  # Libera los objetos de la página ya leída
+    text_cache_put(cache_key, page_texts)
+    return "".join(page_texts)
 
 # Función para extraer la información solicitada
 def extract_info_from_text(text, prompt):
-    response = query_llama_3(api_key, api_url, text, prompt)
-    data = {}
-    if response:
-        for line in response.split('\n'):
-            if ':' in line:
-                key, value = line.split(':', 1)
-                data[key.strip()] = value.strip()
-    return data
+    prompt += "\nResponde únicamente con un objeto JSON con las claves: " + ", ".join(INVOICE_FIELDS) + "\n"
+    return query_fields(text, prompt, INVOICE_FIELDS)
+
+# Función para buscar el período de facturación (dos fechas en la línea que lo menciona)
+def find_billing_period(lines):
+    for index, line in enumerate(lines):
+        if re.search(r'per[ií]odo', line, re.IGNORECASE):
+            dates = find_dates(line + ' ' + (lines[index + 1] if index + 1 < len(lines) else ''))
+            if len(dates) >= 2 and dates[0] < dates[1]:
+                return f"{dates[0].strftime('%d/%m/%Y')} - {dates[1].strftime('%d/%m/%Y')}"
+    return None
+
+# Expresión del consumo en kWh (miles con punto y decimales con coma); no vale si sigue una unidad por tiempo
+# ("kWh/día") ni si la cifra forma parte de un precio ("0,12 €/kWh" no coincide: la cifra no precede a kWh)
+KWH_PATTERN = r'(\d{1,3}(?:\.\d{3})+(?:,\d+)?|\d+(?:,\d+)?)\s*kWh\b(?!\s*/)'
+
+# Líneas de consumo que no contienen el consumo facturado (medias, históricos, comparativas, precios)
+KWH_EXCLUDED_PATTERN = r'medi[oa]|diari|promedio|precio|hist[óo]ric|anterior|año pasado|mismo periodo|comparativ'
+
+# Función para convertir una cifra de kWh en formato español ("1.234,5") a número
+def parse_kwh(value):
+    return float(value.replace('.', '').replace(',', '.'))
+
+# Función para buscar el consumo en kWh en las líneas que hablan de consumo
+# Solo se acepta una cifra plausible (mayor que cero y no mayor que max_consumption_kwh) y sin ambigüedad:
+# si hay varias cifras distintas (periodos P1/P2/P3, lecturas) se usa la de la línea del total y, si tampoco
+# hay una sola, el campo queda para el LLM
+def find_consumption_kwh(text):
+    values, total_values = {}, {}
+    for line in text.splitlines():
+        if not re.search(r'consumo', line, re.IGNORECASE) or re.search(KWH_EXCLUDED_PATTERN, line, re.IGNORECASE):
+            continue
+        for match in re.finditer(KWH_PATTERN, line, re.IGNORECASE):
+            kwh = parse_kwh(match.group(1))
+            if 0 < kwh <= max_consumption_kwh:
+                values.setdefault(kwh, match.group(1))
+                if re.search(r'\btotal\b', line, re.IGNORECASE):
+                    total_values.setdefault(kwh, match.group(1))
+    for candidates in (values, total_values):
+        if len(candidates) == 1:
+            return f"{next(iter(candidates.values()))} kWh"
+    return None
+
+# Función para extraer con reglas deterministas los campos con formato fijo (sin llamar al LLM)
+def extract_info_with_rules(text):
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    candidates = {
+        'Número de factura': find_invoice_number(text),
+        'Fecha de emisión de la factura': find_invoice_date(lines),
+        'Período de facturación': find_billing_period(lines),
+        'Consumo kWh': find_consumption_kwh(text)
+    }
+    return {field: value for field, value in candidates.items() if value}
+
+# Función para extraer los campos indicados con una sola llamada al LLM (prompt con esquema JSON)
+def extract_info_single_pass(text, fields=INVOICE_FIELDS):
+    fields_schema = ',\n'.join(f'  "{field}": "..."' for field in fields)
+    prompt_single_pass = fit_prompt(lambda invoice_text: (
+        "Extrae de la siguiente factura la información indicada y responde únicamente con un objeto JSON "
+        "con exactamente estas claves, sin ningún texto adicional:\n"
+        "{\n" + fields_schema + "\n}\n"
+        "Si un dato no aparece en la factura, deja su valor como una cadena vacía.\n\n"
+        f"Texto de la factura:\n{invoice_text}\n"
+    ), normalize_text(text), prompt_token_budget)
+    return query_fields(text, prompt_single_pass, fields)
 
 # Función para normalizar los nombres de los campos
 def normalize_data(data, filename):
     normalized_data = {
-        'Número de factura': data.get('* Número de factura', '').replace('*', '').strip(),
-        'Razón social del proveedor': data.get('* Razón social del proveedor', '').replace('*', '').strip(),
-        'Consumo kWh': data.get('* Consumo kWh', 'No especificado').replace('*', '').strip(),
-        'Fecha de emisión de la factura': data.get('* Fecha de emisión de la factura', 'No especificada').replace('*', '').strip(),
-        'Período de facturación': data.get('* Período de facturación', 'No especificado').replace('*', '').strip(),
+        'Número de factura': data.get('Número de factura', '').replace('*', '').strip(),
+        'Razón social del proveedor': data.get('Razón social del proveedor', '').replace('*', '').strip(),
+        'Consumo kWh': data.get('Consumo kWh', 'No especificado').replace('*', '').strip(),
+        'Fecha de emisión de la factura': data.get('Fecha de emisión de la factura', 'No especificada').replace('*', '').strip(),
+        'Período de facturación': data.get('Período de facturación', 'No especificado').replace('*', '').strip(),
         'Nombre del archivo': filename
     }
     return normalized_data
@@ -67,28 +137,23 @@ def write_to_csv(data, csv_file_path):
         'Fecha de emisión de la factura', 'Período de facturación', 'Nombre del archivo'
     ]
     
-    file_exists = os.path.isfile(csv_file_path)
-    with open(csv_file_path, mode='a', newline='', encoding='utf-8') as csv_file:
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-        if not file_exists:
-            writer.writeheader()
-        writer.writerow({field: data.get(field, '') for field in fieldnames})
+    # Varias facturas se procesan a la vez: solo un hilo escribe en el CSV cada vez
+    with csv_lock:
+        file_exists = os.path.isfile(csv_file_path)
+        with open(csv_file_path, mode='a', newline='', encoding='utf-8') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+            if not file_exists:
+                writer.writeheader()
+            writer.writerow({field: data.get(field, '') for field in fieldnames})
 
-# Función principal para procesar un archivo PDF
-def process_invoice(pdf_path, api_key, api_url, csv_file_path):
-    filename = os.path.basename(pdf_path)
-    print(f"Procesando el archivo: {pdf_path}")
-
-    # Extrae el texto del archivo PDF completo
-    text = extract_text_from_pdf(pdf_path)
-
-    # Prompt para limpiar y formatear el texto
-    prompt_cleanup = (
+# Función para construir el prompt de limpieza del texto extraído
+def build_cleanup_prompt(text):
+    return (
         "Has recibido un texto extraído de una factura con una estructura y un diseño complejos. "
         "Tu tarea es limpiar y simplificar el texto para que sea lo más claro y legible posible. "
         "Elimina cualquier ruido, errores y formateo innecesario, haciéndolo fácilmente legible.\n\n"
         "Texto extraído:\n"
-        f"{text[:2000]}\n\n"
+        f"{text}\n\n"
         "Instrucciones:\n"
         "- Elimina cualquier ruido, caracteres especiales o formato innecesario.\n"
         "- Corrige errores de transcripción u ortografía.\n"
@@ -96,6 +161,11 @@ def process_invoice(pdf_path, api_key, api_url, csv_file_path):
         "- No es necesario un formato específico, pero el texto debe ser fácilmente legible."
     )
 
+# Función para extraer la información con la cadena de tres llamadas (limpieza, orden y extracción)
+def extract_info_multi_step(text):
+    # Prompt para limpiar y formatear el texto (ajustado al presupuesto de tokens)
+    prompt_cleanup = fit_prompt(build_cleanup_prompt, text, prompt_token_budget)
+
     formatted_text = clean_and_format_text(text, prompt_cleanup)
 
     # Prompt para ordenar el texto formateado y eliminar caracteres especiales
@@ -125,6 +195,32 @@ def process_invoice(pdf_path, api_key, api_url, csv_file_path):
     data_from_text = extract_info_from_text(ordered_text, prompt_extraction)
     print("\nInformación extraída:")
     print(data_from_text)
+    return data_from_text
+
+# Función principal para procesar un archivo PDF
+def process_invoice(pdf_path, api_key, api_url, csv_file_path, file_hash=None):
+    filename = os.path.basename(pdf_path)
+    print(f"Procesando el archivo: {pdf_path}")
+
+    # Extrae el texto del archivo PDF completo
+    text = extract_text_from_pdf(pdf_path, file_hash)
+
+    # Primero las reglas deterministas: el LLM solo se consulta para los campos que falten
+    data_from_text = extract_info_with_rules(text) if use_rules else {}
+    missing_fields = get_missing_fields(data_from_text)
+    if use_rules:
+        print(f"\nInformación validada por las reglas (campos faltantes: {missing_fields or 'ninguno'}):")
+        print(data_from_text)
+
+    # Una sola llamada con los campos que faltan; la cadena de tres llamadas solo se usa si siguen faltando datos
+    if missing_fields and single_pass:
+        merge_missing_fields(data_from_text, extract_info_single_pass(text, missing_fields))
+        missing_fields = get_missing_fields(data_from_text)
+        print(f"\nInformación extraída en una sola llamada (campos faltantes: {missing_fields or 'ninguno'}):")
+        print(data_from_text)
+
+    if missing_fields and (single_pass_fallback or not single_pass):
+        merge_missing_fields(data_from_text, extract_info_multi_step(text))
 
     # Controlla los datos antes de escribirlos en el CSV
     print("\nDatos normalizados:")
@@ -134,6 +230,54 @@ def process_invoice(pdf_path, api_key, api_url, csv_file_path):
     # Normaliza y escribe los datos extraídos en el archivo CSV
     write_to_csv(normalized_data, csv_file_path)
 
+# Función para calcular la versión del pipeline: cambia si cambia la configuración que afecta a los resultados
+def get_pipeline_version():
+    config = {
+        'pipeline_version': pipeline_version,
+        'fields': INVOICE_FIELDS,
+        'use_rules': use_rules,
+        'single_pass': single_pass,
+        'single_pass_fallback': single_pass_fallback,
+        'llm_model': llm_model,
+        'prompt_token_budget': prompt_token_budget,
+        'max_consumption_kwh': max_consumption_kwh
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+# Función para procesar varias facturas a la vez (ollama_num_parallel documentos en curso)
+# Solo se procesan los PDF nuevos o modificados según el manifiesto; el resultado de cada uno queda registrado
+def process_invoices(pdf_paths, api_key, api_url, csv_file_path, max_workers=None):
+    manifest = load_manifest(manifest_path)
+    version = get_pipeline_version()
+
+    pending = {}
+    for pdf_path in pdf_paths:
+        key = os.path.abspath(pdf_path)
+        fingerprint = get_file_fingerprint(pdf_path, manifest.get(key))
+        if needs_processing(manifest.get(key), fingerprint, version):
+            pending[pdf_path] = fingerprint
+    print(f"Facturas sin cambios omitidas: {len(pdf_paths) - len(pending)}, por procesar: {len(pending)}")
+
+    with ThreadPoolExecutor(max_workers=max_workers or ollama_num_parallel) as executor:
+        futures = {
+            executor.submit(
+                process_invoice, pdf_path, api_key, api_url, csv_file_path, pending[pdf_path]['hash']
+            ): pdf_path
+            for pdf_path in pending
+        }
+        for future in as_completed(futures):
+            pdf_path = futures[future]
+            try:
+                future.result()
+                status = 'done'
+            except Exception as e:
+                print(f"Error procesando {pdf_path}: {e}")
+                status = 'error'
+            manifest[os.path.abspath(pdf_path)] = dict(pending[pdf_path], pipeline_version=version, status=status)
+            save_manifest(manifest, manifest_path)
+
+    dedupe_csv(csv_file_path, 'Nombre del archivo')
+
 # Ruta de la carpeta que contiene los archivos PDF de las facturas
 pdf_folder_path = "/home/paolo/facturalia/ollama_test/bill_chris"
 
@@ -144,9 +288,78 @@ csv_file_path = '/home/paolo/facturalia/ollama_test/csv/chris_isemaren.csv'
 api_key = 'ollama'  
 api_url = 'http://localhost:11434/api/generate'
 
-# Procesa cada archivo PDF en la carpeta especificada uno a la vez
-for filename in os.listdir(pdf_folder_path):
-    if filename.endswith(".pdf"):
-        pdf_path = os.path.join(pdf_folder_path, filename)
-        process_invoice(pdf_path, api_key, api_url, csv_file_path)
+# Peticiones simultáneas a Ollama: debe coincidir con OLLAMA_NUM_PARALLEL del servidor
+ollama_num_parallel = int(os.environ.get('OLLAMA_NUM_PARALLEL', 4))
+csv_lock = threading.Lock()
+
+# Caché de respuestas del LLM: ruta, tamaño máximo y activación (False para ignorarla)
+llm_cache_path = os.path.join(os.path.dirname(csv_file_path), 'llm_cache.sqlite')
+llm_cache_max_bytes = 200 * 1024 * 1024
+llm_cache_enabled = True
+
+# Caché del texto extraído de los PDF: ruta, tamaño máximo y activación (False para leer siempre los PDF)
+text_cache_path = os.path.join(os.path.dirname(csv_file_path), 'text_cache.sqlite')
+text_cache_max_bytes = 500 * 1024 * 1024
+text_cache_enabled = True
+
+# Manifiesto de archivos procesados: los PDF sin cambios no se vuelven a procesar
+# (incrementa pipeline_version al modificar los prompts para forzar un nuevo procesamiento)
+manifest_path = csv_file_path + '.manifest.json'
+pipeline_version = 1
+
+# Extracción en una sola llamada (True) o con la cadena de tres llamadas (False);
+# con single_pass_fallback la cadena se usa igualmente para completar los campos que falten
+single_pass = True
+single_pass_fallback = True
+
+# Reglas deterministas (número de factura, fechas, período, consumo) antes del LLM:
+# el LLM solo se usa para los campos que falten
+use_rules = True
+
+# Consumo máximo plausible de una factura (kWh): las cifras mayores no se aceptan en las reglas
+max_consumption_kwh = 1000000
+
+# Modelo de Ollama, ventana de contexto (num_ctx) y tokens máximos del prompt (instrucciones + texto):
+# el texto de la factura se ajusta a ese presupuesto por líneas, conservando el principio y el final
+llm_model = 'llama3'
+llm_num_ctx = 4096
+prompt_token_budget = 2000
+
+# Lectura en streaming de la respuesta con los campos: se corta en cuanto han llegado todos
+use_streaming = True
+
+# Tokens máximos generados para la respuesta JSON con los campos
+extraction_num_predict = 250
+
+# Configuración de las funciones comunes (invoice_common.py)
+invoice_common.configure(
+    invoice_fields=INVOICE_FIELDS,
+    api_key=api_key,
+    api_url=api_url,
+    ollama_num_parallel=ollama_num_parallel,
+    llm_cache_path=llm_cache_path,
+    llm_cache_max_bytes=llm_cache_max_bytes,
+    llm_cache_enabled=llm_cache_enabled,
+    text_cache_path=text_cache_path,
+    text_cache_max_bytes=text_cache_max_bytes,
+    text_cache_enabled=text_cache_enabled,
+    llm_model=llm_model,
+    llm_num_ctx=llm_num_ctx,
+    use_streaming=use_streaming,
+    extraction_num_predict=extraction_num_predict
+)
+
+# Procesa los archivos PDF de la carpeta especificada, varios a la vez
+pdf_paths = [
+    os.path.join(pdf_folder_path, filename)
+    for filename in os.listdir(pdf_folder_path)
+    if filename.endswith(".pdf")
+]
+process_invoices(pdf_paths, api_key, api_url, csv_file_path)
+print(f"Caché LLM: {llm_cache_stats['hits']} aciertos, {llm_cache_stats['misses']} fallos, "
+      f"{llm_cache_stats['evictions']} entradas eliminadas")
+print(f"Caché de texto: {text_cache_stats['hits']} aciertos, {text_cache_stats['misses']} fallos, "
+      f"{text_cache_stats['evictions']} entradas eliminadas")
+print(f"Tokens: {token_stats['calls']} llamadas, {token_stats['prompt_tokens']} de entrada, "
+      f"{token_stats['completion_tokens']} de salida")
 
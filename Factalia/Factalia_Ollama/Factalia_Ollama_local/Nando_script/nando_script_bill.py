@@ -1,68 +1,340 @@
 import pdfplumber
-import requests
 import csv
 import os
+import re
+import sys
+import threading
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# Función para extraer el texto de una página específica de un PDF
-def extract_text_from_page(pdf_path, page_number):
-    text = ""
-    with pdfplumber.open(pdf_path) as pdf:
-        if page_number < len(pdf.pages):
-            page = pdf.pages[page_number]
-            text = page.extract_text() or ""
-    return text
-
-# Función para enviar el texto al modelo LLaMA 3 y obtener una respuesta
-def query_llama_3(api_key, api_url, text, prompt):
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
+# Funciones comunes a los scripts de Chris y Nando (Ollama, reglas, manifiesto): invoice_common.py,
+# en la carpeta superior
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import invoice_common
+from invoice_common import (
+    query_fields, clean_and_format_text, get_missing_fields, merge_missing_fields, normalize_text,
+    find_invoice_number, find_invoice_date, load_manifest, save_manifest, get_file_fingerprint,
+    needs_processing, dedupe_csv
+)
+
+# Hash, cachés y presupuesto de tokens: factalia_common.py (carpeta Factalia), importable tras invoice_common
+from factalia_common import (
+    text_cache_key, text_cache_get, text_cache_put, file_sha256, fit_prompt, llm_cache_stats, text_cache_stats,
+    token_stats
+)
+
+# Campos que se extraen de cada factura (mismo orden que en el prompt de extracción)
+INVOICE_FIELDS = [
+    'Número de factura',
+    'Fecha de factura',
+    'Compañía del servicio',
+    'NIF o CIF de la compañía del servicio',
+    'Cliente',
+    'NIF o CIF del cliente',
+    'IVA',
+    'Total IVA',
+    'Imponible o base total',
+    'Total'
+]
+
+# Tipos de IVA vigentes en España
+VALID_VAT_RATES = {0.0, 4.0, 5.0, 10.0, 21.0}
+
+# Función para preparar la lectura de un PDF bajo demanda: el PDF se abre una sola vez, y solo si alguna
+# página pedida no está en la caché de texto (file_hash evita recalcular el hash si ya se conoce)
+def open_document(pdf_path, file_hash=None):
+    return {
+        'path': pdf_path,
+        'hash': file_hash or file_sha256(pdf_path),
+        'pdf': None,
+        'page_count': None,
+        'texts': {}
     }
-    payload = {
-        "model": "llama3",
-        "prompt": prompt,
-        "stream": False,
-        "max_tokens": 3500
+
+# Función para obtener las páginas del PDF, abriéndolo solo la primera vez que hace falta
+def get_pdf_pages(document):
+    if document['pdf'] is None:
+        document['pdf'] = pdfplumber.open(document['path'])
+    return document['pdf'].pages
+
+# Función para obtener el texto de una página (numerada desde 1), leyéndola solo la primera vez que se pide
+# El texto queda en la caché de texto: al cambiar los prompts no se vuelve a leer el PDF
+def get_page_text(document, page_number):
+    if page_number not in document['texts']:
+        cache_key = text_cache_key(
+            document['hash'], 'pdfplumber', {'version': pdfplumber.__version__, 'page': page_number}
+        )
+        cached_page = text_cache_get(cache_key)
+        if cached_page is None:
+            pages = get_pdf_pages(document)
+            text = ""
+            if page_number <= len(pages):
+                text = pages[page_number - 1].extract_text() or ""
+                pages[page_number - 1].flush_cache()  # Libera los objetos de la página ya leída
+            cached_page = {'text': text, 'page_count': len(pages)}
+            text_cache_put(cache_key, cached_page)
+        document['texts'][page_number] = cached_page['text']
+        document['page_count'] = cached_page['page_count']
+    return document['texts'][page_number]
+
+# Función para obtener un avance barato de una página, suficiente para puntuarla (ver get_page_order):
+# los primeros page_preview_chars caracteres en el orden del PDF (page.chars), separados por espacios y saltos
+# de línea según su posición, sin el análisis de disposición de extract_text.
+# Si el texto completo de la página ya se ha leído se usa ese; el avance también queda en la caché de texto
+def get_page_preview(document, page_number):
+    if page_number in document['texts']:
+        return document['texts'][page_number]
+    cache_key = text_cache_key(
+        document['hash'], 'pdfplumber-preview',
+        {'version': pdfplumber.__version__, 'page': page_number, 'chars': page_preview_chars}
+    )
+    preview = text_cache_get(cache_key)
+    if preview is None:
+        page = get_pdf_pages(document)[page_number - 1]
+        parts, previous = [], None
+        for char in page.chars[:page_preview_chars]:
+            if previous is not None and abs(char['top'] - previous['top']) > 2:
+                parts.append('\n')
+            elif previous is not None and char['x0'] - previous['x1'] > 1:
+                parts.append(' ')
+            parts.append(char['text'])
+            previous = char
+        page.flush_cache()
+        preview = ''.join(parts)
+        text_cache_put(cache_key, preview)
+    return preview
+
+# Función para cerrar el PDF del documento si se ha llegado a abrir
+def close_document(document):
+    if document['pdf'] is not None:
+        document['pdf'].close()
+        document['pdf'] = None
+
+# Función para extraer la información solicitada (solo los campos indicados)
+def extract_info_from_text(text, prompt, fields=INVOICE_FIELDS):
+    prompt += "\nResponde únicamente con un objeto JSON con las claves: " + ", ".join(fields) + "\n"
+    return query_fields(text, prompt, fields)
+
+# Letras de control del DNI/NIE y del CIF
+DNI_LETTERS = 'TRWAGMYFPDXBNJZSQVHLCKE'
+CIF_CONTROL_LETTERS = 'JABCDEFGHI'
+
+# Expresiones de las reglas deterministas (formatos españoles de facturas)
+TAX_ID_PATTERN = r'\b(?:ES[\s-]?)?([A-HJNP-SUVW]-?\d{7}-?[0-9A-J]|\d{8}-?[A-Z]|[XYZ]-?\d{7}-?[A-Z])\b'
+AMOUNT_PATTERN = r'\d{1,3}(?:\.\d{3})+,\d{2}|\d+,\d{2}|\d+\.\d{2}(?!\d)'
+
+# Función para validar un NIF, NIE o CIF español con su dígito o letra de control
+def is_valid_tax_id(value):
+    value = re.sub(r'[\s.-]', '', value.upper())
+    if value.startswith('ES') and len(value) == 11:
+        value = value[2:]
+    if re.fullmatch(r'\d{8}[A-Z]', value):
+        return DNI_LETTERS[int(value[:8]) % 23] == value[8]
+    if re.fullmatch(r'[XYZ]\d{7}[A-Z]', value):
+        number = str('XYZ'.index(value[0])) + value[1:8]
+        return DNI_LETTERS[int(number) % 23] == value[8]
+    if re.fullmatch(r'[A-HJNP-SUVW]\d{7}[0-9A-J]', value):
+        digits = value[1:8]
+        even_sum = sum(int(digit) for digit in digits[1::2])
+        odd_sum = sum(sum(divmod(int(digit) * 2, 10)) for digit in digits[0::2])
+        control = (10 - (even_sum + odd_sum) % 10) % 10
+        if value[0] in 'NPQRSW':
+            return value[8] == CIF_CONTROL_LETTERS[control]
+        if value[0] in 'ABEH':
+            return value[8] == str(control)
+        return value[8] in (str(control), CIF_CONTROL_LETTERS[control])
+    return False
+
+# Función para convertir un importe en formato español ("1.234,56") o inglés ("1234.56") a número
+def parse_amount(value):
+    value = value.replace(' ', '')
+    if ',' in value:
+        value = value.replace('.', '').replace(',', '.')
+    return float(value)
+
+# Función para obtener los NIF/CIF válidos de un texto (sin guiones ni prefijo ES)
+def find_tax_ids(text):
+    tax_ids = []
+    for match in re.finditer(TAX_ID_PATTERN, text.upper()):
+        tax_id = match.group(1).replace('-', '')
+        if is_valid_tax_id(tax_id) and tax_id not in tax_ids:
+            tax_ids.append(tax_id)
+    return tax_ids
+
+# Función para separar el NIF/CIF de la compañía del del cliente según el contexto de la línea
+# (solo se devuelve un valor si no hay ambigüedad)
+def find_company_and_client_tax_ids(lines):
+    company_ids, client_ids = [], []
+    for index, line in enumerate(lines):
+        context = ' '.join(lines[max(index - 1, 0):index + 1]).lower()
+        for tax_id in find_tax_ids(line):
+            if tax_id in company_ids or tax_id in client_ids:
+                continue
+            if re.search(r'cliente|titular|destinatario|facturar a', context):
+                client_ids.append(tax_id)
+            else:
+                company_ids.append(tax_id)
+    company_id = company_ids[0] if len(company_ids) == 1 else None
+    client_id = client_ids[0] if len(client_ids) == 1 else None
+    return company_id, client_id
+
+# NIF/CIF que las reglas atribuyen a la compañía o al cliente según el contexto de la línea: como el diseño
+# de la factura no siempre lo deja claro, se piden también al LLM para confirmar la atribución
+REVIEWED_RULE_FIELDS = ['NIF o CIF de la compañía del servicio', 'NIF o CIF del cliente']
+
+# Función para revisar con la respuesta del LLM los NIF/CIF atribuidos por las reglas (pending_review)
+# Si el LLM asigna al campo otro NIF/CIF válido que aparece en el texto (p. ej. compañía y cliente intercambiados)
+# prevalece el del LLM; si el LLM no da ninguno se mantiene el de las reglas y el campo sigue pendiente
+def review_rule_fields(data, llm_data, pending_review, text):
+    document_ids = find_tax_ids(text)
+    for field in list(pending_review):
+        llm_ids = find_tax_ids(llm_data.get(field) or '')
+        if not llm_ids:
+            continue
+        pending_review.discard(field)
+        if llm_ids[0] != data[field] and llm_ids[0] in document_ids:
+            print(f"{field}: las reglas indicaban {data[field]} y el LLM {llm_ids[0]}; se usa el del LLM")
+            data[field] = llm_ids[0]
+
+# Función para obtener los campos que se piden al LLM: los que faltan y los de las reglas pendientes de revisión
+def get_query_fields(data, pending_review):
+    missing_fields = get_missing_fields(data)
+    return [field for field in INVOICE_FIELDS if field in missing_fields or field in pending_review]
+
+# Función para buscar el tipo de IVA (solo si la factura usa un único tipo válido)
+def find_vat_rate(lines):
+    rates = set()
+    for line in lines:
+        if re.search(r'\biva\b', line.lower()):
+            for rate in re.findall(r'(\d{1,2}(?:[.,]\d{1,2})?)\s*%', line):
+                rate = float(rate.replace(',', '.'))
+                if rate in VALID_VAT_RATES:
+                    rates.add(rate)
+    return rates.pop() if len(rates) == 1 else None
+
+# Función para buscar base imponible, cuota de IVA y total que cuadren entre sí (base + IVA = total)
+def find_vat_amounts(lines, vat_rate):
+    bases, taxes, totals = [], [], []
+    for line in lines:
+        lower = line.lower()
+        amounts = re.findall(AMOUNT_PATTERN, line)
+        if re.search(r'\b(?:base|imponible)\b', lower):
+            bases.extend(amounts)
+        if re.search(r'\biva\b', lower):
+            taxes.extend(amounts)
+        if re.search(r'\btotal\b', lower):
+            totals.extend(amounts)
+
+    for total in sorted(set(totals), key=parse_amount, reverse=True):
+        for base in bases:
+            for tax in taxes:
+                base_value, tax_value = parse_amount(base), parse_amount(tax)
+                if base_value <= 0 or abs(base_value + tax_value - parse_amount(total)) > 0.02:
+                    continue
+                if vat_rate is not None and abs(base_value * vat_rate / 100 - tax_value) > 0.02:
+                    continue
+                return base, tax, total
+    return None
+
+# Función para extraer con reglas deterministas los campos con formato fijo (sin llamar al LLM)
+def extract_info_with_rules(text):
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    company_id, client_id = find_company_and_client_tax_ids(lines)
+    vat_rate = find_vat_rate(lines)
+    candidates = {
+        'Número de factura': find_invoice_number(text),
+        'Fecha de factura': find_invoice_date(lines),
+        'NIF o CIF de la compañía del servicio': company_id,
+        'NIF o CIF del cliente': client_id,
+        'IVA': f"{vat_rate:g}%" if vat_rate is not None else None
     }
-    
-    response = requests.post(api_url, headers=headers, json=payload)
-    
-    if response.status_code != 200:
-        print(f"Error: {response.status_code} - {response.text}")
-        return None
-
-    return response.json().get('response', '')
-
-# Función para limpiar y formatear el texto
-def clean_and_format_text(text, prompt):
-    response = query_llama_3(api_key, api_url, text, prompt)
-    return response if response else ""
-
-# Función para extraer la información requerida
-def extract_info_from_text(text, prompt):
-    response = query_llama_3(api_key, api_url, text, prompt)
-    data = {}
-    if response:
-        for line in response.split('\n'):
-            if ':' in line:
-                key, value = line.split(':', 1)
-                data[key.strip()] = value.strip()
-    return data
+    vat_amounts = find_vat_amounts(lines, vat_rate)
+    if vat_amounts:
+        candidates['Imponible o base total'], candidates['Total IVA'], candidates['Total'] = vat_amounts
+    return {field: value for field, value in candidates.items() if value}
+
+# Palabras clave que indican que una página contiene los campos de la factura, con su peso en la puntuación
+PAGE_KEYWORDS = {
+    r'factura': 3,
+    r'fecha': 1,
+    r'cliente|titular': 1,
+    r'\bc\.?i\.?f\b|\bn\.?i\.?f\b': 2,
+    r'base\s+imponible|imponible': 3,
+    r'\biva\b': 2,
+    r'\btotal\b': 3,
+    r'importe|subtotal': 1
+}
+
+# Función para puntuar una página según la probabilidad de que contenga los campos buscados
+# (palabras clave, importes y NIF/CIF válidos; sin llamar al LLM)
+def score_page(text):
+    score = sum(weight for pattern, weight in PAGE_KEYWORDS.items() if re.search(pattern, text, re.IGNORECASE))
+    score += 0.5 * min(len(re.findall(AMOUNT_PATTERN, text)), 10)
+    score += 2 * min(len(find_tax_ids(text)), 2)
+    return score
+
+# Función para elegir las page_budget páginas con mejor puntuación, ordenadas de mayor a menor puntuación
+# (a igualdad de puntuación se prefieren la primera y la última página, y luego las primeras)
+def select_pages(pages):
+    if not pages:
+        return [{'page': 1, 'text': ''}]
+    scores = {page['page']: score_page(page['text']) for page in pages}
+    edges = (pages[0]['page'], pages[-1]['page'])
+    ranked = sorted(pages, key=lambda page: (-scores[page['page']], page['page'] not in edges, page['page']))
+    selected = ranked[:page_budget]
+    if len(pages) > page_budget:
+        summary = ', '.join(f"{page['page']} ({scores[page['page']]:g})" for page in selected)
+        print(f"Páginas seleccionadas (puntuación): {summary} de {len(pages)} candidatas")
+    return selected
+
+# Función para decidir en qué orden se consultan las páginas (como máximo page_budget)
+# Si el documento no tiene más páginas que page_budget se siguen en orden y las siguientes a la primera
+# solo se leen si hacen falta; si tiene más, se puntúan las candidatas (las primeras page_scan_limit
+# y la última) con su avance (get_page_preview) y se consultan de mayor a menor puntuación.
+# El texto completo solo se extrae después, para las páginas que realmente se consultan
+def get_page_order(document):
+    get_page_text(document, 1)  # La primera página da también el número de páginas
+    page_count = document['page_count']
+    if page_count <= page_budget:
+        return list(range(1, max(page_count, 1) + 1))
+
+    candidates = list(range(1, page_count + 1))
+    if page_count > page_scan_limit:
+        candidates = candidates[:page_scan_limit - 1] + [page_count]
+    pages = [{'page': page_number, 'text': get_page_preview(document, page_number)} for page_number in candidates]
+    return [page['page'] for page in select_pages(pages)]
+
+# Función para extraer los campos indicados con una sola llamada al LLM (prompt con esquema JSON)
+def extract_info_single_pass(text, fields=INVOICE_FIELDS):
+    fields_schema = ',\n'.join(f'  "{field}": "..."' for field in fields)
+    prompt_single_pass = fit_prompt(lambda invoice_text: (
+        "Extrae de la siguiente factura la información indicada y responde únicamente con un objeto JSON "
+        "con exactamente estas claves, sin ningún texto adicional:\n"
+        "{\n" + fields_schema + "\n}\n"
+        "Notas:\n"
+        "- IVA es generalmente un valor porcentual.\n"
+        "- Total IVA es el importe del IVA.\n"
+        "- Imponible o base total corresponde al total menos el Total IVA.\n"
+        "Si un dato no aparece en la factura, deja su valor como una cadena vacía.\n\n"
+        f"Texto de la factura:\n{invoice_text}\n"
+    ), normalize_text(text), prompt_token_budget)
+    return query_fields(text, prompt_single_pass, fields)
 
 # Función para normalizar los nombres de los campos
 def normalize_data(data, filename):
     normalized_data = {
         'nombre del archivo': filename,
-        'número de factura': data.get('* Número de factura', 'None'),
-        'fecha de factura': data.get('* Fecha de factura o fecha de emisión de factura', 'None'),
-        'Compañía del servicio': data.get('* Compañía del servicio', 'None'),
-        'NIF o CIF de la compañía del servicio': data.get('* NIF o CIF de la compañía del servicio', 'None'),
-        'Cliente': data.get('* Cliente', 'None'),
-        'NIF o CIF del cliente': data.get('* NIF o CIF del cliente', 'None'),
-        'IVA': data.get('* IVA', 'None'),
-        'Total IVA': data.get('* Total IVA', 'None'),
-        'Imponible o base total': data.get('* Imponible o base total', 'None'),
-        'total': data.get('* Total', 'None')
+        'número de factura': data.get('Número de factura', 'None'),
+        'fecha de factura': data.get('Fecha de factura', 'None'),
+        'Compañía del servicio': data.get('Compañía del servicio', 'None'),
+        'NIF o CIF de la compañía del servicio': data.get('NIF o CIF de la compañía del servicio', 'None'),
+        'Cliente': data.get('Cliente', 'None'),
+        'NIF o CIF del cliente': data.get('NIF o CIF del cliente', 'None'),
+        'IVA': data.get('IVA', 'None'),
+        'Total IVA': data.get('Total IVA', 'None'),
+        'Imponible o base total': data.get('Imponible o base total', 'None'),
+        'total': data.get('Total', 'None')
     }
     return normalized_data
 
@@ -74,28 +346,23 @@ def write_to_csv(data, csv_file_path):
         'NIF o CIF del cliente', 'IVA', 'Total IVA', 'Imponible o base total', 'total'
     ]
     
-    file_exists = os.path.isfile(csv_file_path)
-    with open(csv_file_path, mode='a', newline='', encoding='utf-8') as csv_file:
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-        if not file_exists:
-            writer.writeheader()
-        writer.writerow(data)
-
-# Función principal para procesar un archivo PDF
-def process_invoice(pdf_path, api_key, api_url, csv_file_path):
-    print(f"Procesando el archivo: {pdf_path}")
-    filename = os.path.basename(pdf_path)  # Extrae solo el nombre del archivo
+    # Varias facturas se procesan a la vez: solo un hilo escribe en el CSV cada vez
+    with csv_lock:
+        file_exists = os.path.isfile(csv_file_path)
+        with open(csv_file_path, mode='a', newline='', encoding='utf-8') as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+            if not file_exists:
+                writer.writeheader()
+            writer.writerow(data)
 
-    # Extrae y limpia el texto de la primera y segunda página
-    text_page_1 = extract_text_from_page(pdf_path, 0)
-    text_page_2 = extract_text_from_page(pdf_path, 1)
-
-    prompt_cleanup = (
+# Función para construir el prompt de limpieza del texto de una página
+def build_cleanup_prompt(text):
+    return (
         "Has recibido un texto extraído de una factura con una estructura y un diseño complejos. "
         "Tu tarea es limpiar y simplificar el texto para hacerlo lo más claro y legible posible. "
         "Elimina cualquier ruido, errores y formato innecesario, haciéndolo fácilmente legible.\n\n"
         "Texto extraído:\n"
-        f"{text_page_1[:2000]}\n\n"
+        f"{text}\n\n"
         "Instrucciones:\n"
         "- Elimina cualquier ruido, caracteres especiales o formato innecesario.\n"
         "- Corrige cualquier error de transcripción u ortografía.\n"
@@ -103,53 +370,144 @@ def process_invoice(pdf_path, api_key, api_url, csv_file_path):
         "- No es necesario un formato específico, pero el texto debe ser fácilmente legible."
     )
 
-    formatted_text_page_1 = clean_and_format_text(text_page_1, prompt_cleanup)
-    formatted_text_page_2 = clean_and_format_text(text_page_2, prompt_cleanup)
+# Descripción de cada campo en el prompt de extracción
+FIELD_DESCRIPTIONS = {
+    'Número de factura': 'número de factura',
+    'Fecha de factura': 'fecha de factura o fecha de emisión de factura',
+    'Compañía del servicio': 'Compañía del servicio',
+    'NIF o CIF de la compañía del servicio': 'NIF o CIF de la compañía del servicio',
+    'Cliente': 'Cliente',
+    'NIF o CIF del cliente': 'NIF o CIF del cliente',
+    'IVA': 'IVA (generalmente es un valor porcentual)',
+    'Total IVA': 'Total IVA (generalmente corresponde al valor numérico del porcentaje sobre el total)',
+    'Imponible o base total': 'Imponible o base total (corresponde al total - Total IVA)',
+    'Total': 'total'
+}
 
-    # Extrae la información de la primera página
-    prompt_extraction = (
+# Función para construir el prompt de extracción a partir del texto ya limpio (solo con los campos indicados)
+def build_extraction_prompt(formatted_text, fields=INVOICE_FIELDS):
+    return (
         "Por favor, extrae solamente la siguiente información del resultado, sin incluir otra información:\n"
-        "- número de factura\n"
-        "- fecha de factura o fecha de emisión de factura\n"
-        "- Compañía del servicio\n"
-        "- NIF o CIF de la compañía del servicio\n"
-        "- Cliente\n"
-        "- NIF o CIF del cliente\n"
-        "- IVA (generalmente es un valor porcentual)\n"
-        "- Total IVA (generalmente corresponde al valor numérico del porcentaje sobre el total)\n"
-        "- Imponible o base total (corresponde al total - Total IVA)\n"
-        "- total\n\n"
-        f"Resultado:\n{formatted_text_page_1}\n"
+        + "".join(f"- {FIELD_DESCRIPTIONS[field]}\n" for field in fields) +
+        f"\nResultado:\n{formatted_text}\n"
     )
-    
-    data_from_page_1 = extract_info_from_text(formatted_text_page_1, prompt_extraction)
-
-    # Si faltan datos, extrae de la segunda página
-    required_fields = [
-        'número de factura', 'fecha de factura', 'Compañía del servicio',
-        'NIF o CIF de la compañía del servicio', 'Cliente',
-        'NIF o CIF del cliente', 'IVA', 'Total IVA',
-        'Imponible o base total', 'total'
-    ]
 
-    missing_fields = [field for field in required_fields if not data_from_page_1.get(field)]
-    
-    if missing_fields:
-        print(f"Información faltante encontrada en la página 1. Revisando la página 2.")
-        prompt_extraction_page_2 = (
-            f"Resultado:\n{formatted_text_page_2}\n"
-        )
-        data_from_page_2 = extract_info_from_text(formatted_text_page_2, prompt_extraction)
-        
-        # Completa los datos faltantes con los de la segunda página
-        for field in missing_fields:
-            if data_from_page_2.get(field):
-                data_from_page_1[field] = data_from_page_2[field]
+# Función para completar los campos que faltan con la cadena de llamadas por página (limpieza y extracción)
+# Las páginas se limpian de una en una y solo si siguen faltando datos; cada extracción pide solo esos campos
+# (y los NIF/CIF de las reglas que el LLM todavía no ha confirmado)
+def extract_info_multi_step(document, page_order, data, pending_review):
+    for page_number in page_order:
+        if not get_missing_fields(data):
+            break
+        fields = get_query_fields(data, pending_review)
+        print(f"Campos faltantes {fields}: revisando la página {page_number} con la cadena de llamadas.")
+        text = get_page_text(document, page_number)
+        formatted_text = clean_and_format_text(text, fit_prompt(build_cleanup_prompt, text, prompt_token_budget))
+        llm_data = extract_info_from_text(formatted_text, build_extraction_prompt(formatted_text, fields), fields)
+        review_rule_fields(data, llm_data, pending_review, text)
+        merge_missing_fields(data, llm_data)
+
+# Función principal para procesar un archivo PDF
+# Las páginas se consultan de una en una (ver get_page_order): la siguiente solo se lee si siguen faltando datos
+def process_invoice(pdf_path, api_key, api_url, csv_file_path, file_hash=None):
+    print(f"Procesando el archivo: {pdf_path}")
+    filename = os.path.basename(pdf_path)  # Extrae solo el nombre del archivo
+
+    document = open_document(pdf_path, file_hash)
+    try:
+        page_order = get_page_order(document)
+        data = {}
+        pending_review = set()  # NIF/CIF de las reglas que el LLM todavía no ha confirmado
+        read_pages = []
+        for page_number in page_order:
+            if read_pages and not get_missing_fields(data):
+                break
+            read_pages.append(page_number)
+            text = get_page_text(document, page_number)
+
+            # Primero las reglas deterministas (sobre todo el texto leído hasta ahora):
+            # el LLM solo se consulta para los campos que falten
+            if use_rules:
+                read_text = "\n".join(get_page_text(document, number) for number in sorted(read_pages))
+                rules_data = extract_info_with_rules(read_text)
+                missing_fields = get_missing_fields(data)
+                pending_review.update(
+                    field for field in REVIEWED_RULE_FIELDS if field in rules_data and field in missing_fields
+                )
+                merge_missing_fields(data, rules_data)
+                print(f"Página {page_number}: información validada por las reglas "
+                      f"(campos faltantes: {get_missing_fields(data) or 'ninguno'})")
+
+            # Una sola llamada por página con los campos que faltan (y los NIF/CIF de las reglas por confirmar)
+            fields = get_query_fields(data, pending_review)
+            if fields and single_pass:
+                llm_data = extract_info_single_pass(text, fields)
+                review_rule_fields(data, llm_data, pending_review, read_text if use_rules else text)
+                merge_missing_fields(data, llm_data)
+                print(f"Página {page_number}: información extraída en una sola llamada "
+                      f"(campos faltantes: {get_missing_fields(data) or 'ninguno'})")
+
+        # La cadena por página solo se usa si siguen faltando datos
+        if get_missing_fields(data) and (single_pass_fallback or not single_pass):
+            extract_info_multi_step(document, page_order, data, pending_review)
+    finally:
+        close_document(document)
 
     # Normaliza y escribe los datos extraídos en el archivo CSV
-    normalized_data = normalize_data(data_from_page_1, filename)
+    normalized_data = normalize_data(data, filename)
     write_to_csv(normalized_data, csv_file_path)
 
+# Función para calcular la versión del pipeline: cambia si cambia la configuración que afecta a los resultados
+def get_pipeline_version():
+    config = {
+        'pipeline_version': pipeline_version,
+        'fields': INVOICE_FIELDS,
+        'use_rules': use_rules,
+        'single_pass': single_pass,
+        'single_pass_fallback': single_pass_fallback,
+        'llm_model': llm_model,
+        'prompt_token_budget': prompt_token_budget,
+        'page_budget': page_budget,
+        'page_scan_limit': page_scan_limit,
+        'page_preview_chars': page_preview_chars,
+        'reviewed_rule_fields': REVIEWED_RULE_FIELDS
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+# Función para procesar varias facturas a la vez (ollama_num_parallel documentos en curso)
+# Solo se procesan los PDF nuevos o modificados según el manifiesto; el resultado de cada uno queda registrado
+def process_invoices(pdf_paths, api_key, api_url, csv_file_path, max_workers=None):
+    manifest = load_manifest(manifest_path)
+    version = get_pipeline_version()
+
+    pending = {}
+    for pdf_path in pdf_paths:
+        key = os.path.abspath(pdf_path)
+        fingerprint = get_file_fingerprint(pdf_path, manifest.get(key))
+        if needs_processing(manifest.get(key), fingerprint, version):
+            pending[pdf_path] = fingerprint
+    print(f"Facturas sin cambios omitidas: {len(pdf_paths) - len(pending)}, por procesar: {len(pending)}")
+
+    with ThreadPoolExecutor(max_workers=max_workers or ollama_num_parallel) as executor:
+        futures = {
+            executor.submit(
+                process_invoice, pdf_path, api_key, api_url, csv_file_path, pending[pdf_path]['hash']
+            ): pdf_path
+            for pdf_path in pending
+        }
+        for future in as_completed(futures):
+            pdf_path = futures[future]
+            try:
+                future.result()
+                status = 'done'
+            except Exception as e:
+                print(f"Error procesando {pdf_path}: {e}")
+                status = 'error'
+            manifest[os.path.abspath(pdf_path)] = dict(pending[pdf_path], pipeline_version=version, status=status)
+            save_manifest(manifest, manifest_path)
+
+    dedupe_csv(csv_file_path, 'nombre del archivo')
+
 # Ruta de la carpeta que contiene los archivos PDF de las facturas
 pdf_folder_path = "/home/paolo/facturalia/ollama_test/bill/"
 
@@ -160,9 +518,81 @@ csv_file_path = '/home/paolo/facturalia/ollama_test/csv/dati_estratti_fatture12.
 api_key = 'ollama'  
 api_url = 'http://localhost:11434/api/generate'
 
-# Procesa cada archivo PDF en la carpeta especificada uno por uno
-for filename in os.listdir(pdf_folder_path):
-    if filename.endswith(".pdf"):
-        pdf_path = os.path.join(pdf_folder_path, filename)
-        process_invoice(pdf_path, api_key, api_url, csv_file_path)
+# Peticiones simultáneas a Ollama: debe coincidir con OLLAMA_NUM_PARALLEL del servidor
+ollama_num_parallel = int(os.environ.get('OLLAMA_NUM_PARALLEL', 4))
+csv_lock = threading.Lock()
+
+# Caché de respuestas del LLM: ruta, tamaño máximo y activación (False para ignorarla)
+llm_cache_path = os.path.join(os.path.dirname(csv_file_path), 'llm_cache.sqlite')
+llm_cache_max_bytes = 200 * 1024 * 1024
+llm_cache_enabled = True
+
+# Caché del texto extraído de los PDF: ruta, tamaño máximo y activación (False para leer siempre los PDF)
+text_cache_path = os.path.join(os.path.dirname(csv_file_path), 'text_cache.sqlite')
+text_cache_max_bytes = 500 * 1024 * 1024
+text_cache_enabled = True
+
+# Manifiesto de archivos procesados: los PDF sin cambios no se vuelven a procesar
+# (incrementa pipeline_version al modificar los prompts para forzar un nuevo procesamiento)
+manifest_path = csv_file_path + '.manifest.json'
+pipeline_version = 1
+
+# Extracción en una sola llamada (True) o con la cadena de llamadas por página (False);
+# con single_pass_fallback la cadena se usa igualmente para completar los campos que falten
+single_pass = True
+single_pass_fallback = True
+
+# Selección de páginas: de las primeras page_scan_limit páginas (y la última) se leen los primeros
+# page_preview_chars caracteres, se puntúan por palabras clave, importes y NIF/CIF, y solo las page_budget
+# mejores se leen completas y pasan a las reglas y al LLM
+page_budget = 2
+page_scan_limit = 20
+page_preview_chars = 1500
+
+# Reglas deterministas (NIF/CIF, fechas, importes...) antes del LLM: el LLM solo se usa para los campos que falten
+use_rules = True
+
+# Modelo de Ollama, ventana de contexto (num_ctx) y tokens máximos del prompt (instrucciones + texto):
+# el texto de la factura se ajusta a ese presupuesto por líneas, conservando el principio y el final
+llm_model = 'llama3'
+llm_num_ctx = 4096
+prompt_token_budget = 2000
+
+# Lectura en streaming de la respuesta con los campos: se corta en cuanto han llegado todos
+use_streaming = True
+
+# Tokens máximos generados para la respuesta JSON con los campos
+extraction_num_predict = 400
+
+# Configuración de las funciones comunes (invoice_common.py)
+invoice_common.configure(
+    invoice_fields=INVOICE_FIELDS,
+    api_key=api_key,
+    api_url=api_url,
+    ollama_num_parallel=ollama_num_parallel,
+    llm_cache_path=llm_cache_path,
+    llm_cache_max_bytes=llm_cache_max_bytes,
+    llm_cache_enabled=llm_cache_enabled,
+    text_cache_path=text_cache_path,
+    text_cache_max_bytes=text_cache_max_bytes,
+    text_cache_enabled=text_cache_enabled,
+    llm_model=llm_model,
+    llm_num_ctx=llm_num_ctx,
+    use_streaming=use_streaming,
+    extraction_num_predict=extraction_num_predict
+)
+
+# Procesa los archivos PDF de la carpeta especificada, varios a la vez
+pdf_paths = [
+    os.path.join(pdf_folder_path, filename)
+    for filename in os.listdir(pdf_folder_path)
+    if filename.endswith(".pdf")
+]
+process_invoices(pdf_paths, api_key, api_url, csv_file_path)
+print(f"Caché LLM: {llm_cache_stats['hits']} aciertos, {llm_cache_stats['misses']} fallos, "
+      f"{llm_cache_stats['evictions']} entradas eliminadas")
+print(f"Caché de texto: {text_cache_stats['hits']} aciertos, {text_cache_stats['misses']} fallos, "
+      f"{text_cache_stats['evictions']} entradas eliminadas")
+print(f"Tokens: {token_stats['calls']} llamadas, {token_stats['prompt_tokens']} de entrada, "
+      f"{token_stats['completion_tokens']} de salida")
 
@@ -0,0 +1,236 @@
+# Funciones comunes a los scripts de Chris y Nando: llamadas a Ollama, reglas de fechas y número de factura,
+# manifiesto y limpieza del CSV. Hash, cachés, presupuesto de tokens y lectura en streaming están en
+# factalia_common.py (carpeta Factalia), compartido también con los scripts de imágenes y de OpenAI.
+# Cada script define sus campos, prompts y rutas y los pasa a configure.
+import csv
+import os
+import re
+import sys
+import datetime
+import json
+
+# factalia_common.py está en la carpeta Factalia: al importar este módulo los scripts también pueden importarlo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import factalia_common
+from factalia_common import (
+    file_sha256, llm_cache_key, llm_cache_get, llm_cache_put, record_token_usage, get_ollama_session,
+    read_stream_until_fields, check_ollama_response, build_fields_schema, validate_fields_response
+)
+
+# Valores con los que el modelo indica que no ha encontrado un dato
+EMPTY_VALUES = {'', 'no especificado', 'no especificada', 'no disponible', 'none', 'null', 'n/a'}
+
+# Función para enviar el texto al modelo LLaMA 3 y obtener una respuesta
+# Antes de llamar a Ollama se consulta la caché persistente de respuestas
+# Como máximo hay ollama_num_parallel peticiones en curso a la vez (ver OLLAMA_NUM_PARALLEL)
+# Con response_format (esquema JSON) Ollama restringe la salida a ese esquema; num_predict limita los tokens generados
+# Con stream_fields la respuesta se lee en streaming y se corta cuando ya han llegado todos esos campos
+# Si Ollama responde con un error se lanza requests.HTTPError (ver check_ollama_response)
+def query_llama_3(api_key, api_url, text, prompt, response_format=None, num_predict=None, stream_fields=None):
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    payload = {
+        "model": factalia_common.llm_model,
+        "prompt": prompt,
+        "stream": False,
+        "max_tokens": 3500,
+        "options": {"num_ctx": llm_num_ctx}
+    }
+    if response_format is not None:
+        payload["format"] = response_format
+    if num_predict is not None:
+        payload["options"]["num_predict"] = num_predict
+    
+    cache_key = llm_cache_key(payload)
+    cached_response = llm_cache_get(cache_key)
+    if cached_response is not None:
+        return cached_response
+
+    if use_streaming and stream_fields is not None:
+        with factalia_common.ollama_slots:
+            response = get_ollama_session().post(
+                api_url, headers=headers, json=dict(payload, stream=True), stream=True
+            )
+            check_ollama_response(response)
+            usage = {}
+            response_text = read_stream_until_fields(response, stream_fields, usage)
+        record_token_usage(prompt, usage)
+        llm_cache_put(cache_key, response_text)
+        return response_text
+
+    with factalia_common.ollama_slots:
+        response = get_ollama_session().post(api_url, headers=headers, json=payload)
+    check_ollama_response(response)
+
+    response_json = response.json()
+    record_token_usage(prompt, response_json)
+    response_text = response_json.get('response', '')
+    llm_cache_put(cache_key, response_text)
+    return response_text
+
+# Función para limpiar y formatear el texto
+def clean_and_format_text(text, prompt):
+    response = query_llama_3(api_key, api_url, text, prompt)
+    return response if response else ""
+
+# Función para pedir los campos al modelo con salida JSON restringida al esquema y leer la respuesta
+def query_fields(text, prompt, fields):
+    response = query_llama_3(
+        api_key, api_url, text, prompt,
+        response_format=build_fields_schema(fields),
+        num_predict=extraction_num_predict,
+        stream_fields=fields
+    )
+    if not response:
+        return {}
+    try:
+        return validate_fields_response(response, fields)
+    except ValueError as e:
+        print(f"Respuesta estructurada no válida: {e}")
+        return {}
+
+# Función para obtener los campos que faltan o que el modelo ha dejado sin valor
+def get_missing_fields(data):
+    return [field for field in invoice_fields if data.get(field, '').strip().lower() in EMPTY_VALUES]
+
+# Función para completar solo los campos que faltan con los datos de otra extracción
+def merge_missing_fields(data, new_data):
+    for field in get_missing_fields(data):
+        if new_data.get(field, '').strip().lower() not in EMPTY_VALUES:
+            data[field] = new_data[field]
+
+# Función para normalizar ligeramente el texto: espacios repetidos y líneas vacías
+def normalize_text(text):
+    lines = (re.sub(r'[ \t]+', ' ', line).strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+# Expresión de las fechas en las reglas deterministas (formato español dd/mm/aaaa)
+DATE_PATTERN = r'\b(\d{1,2})[/.-](\d{1,2})[/.-](\d{4}|\d{2})\b'
+
+# Función para leer una fecha dd/mm/aaaa validándola; devuelve None si no es una fecha real
+def parse_date(day, month, year):
+    if len(year) == 2:
+        year = '20' + year
+    try:
+        return datetime.date(int(year), int(month), int(day))
+    except ValueError:
+        return None
+
+# Función para obtener todas las fechas válidas de una línea
+def find_dates(line):
+    dates = (parse_date(*match.groups()) for match in re.finditer(DATE_PATTERN, line))
+    return [date for date in dates if date is not None]
+
+# Función para buscar el número de factura junto a su etiqueta ("Nº factura", "Número de factura", ...)
+def find_invoice_number(text):
+    pattern = (
+        r'(?:n[úu]mero\s+de\s+(?:la\s+)?factura|n[º°o]\.?\s*(?:de\s+)?factura|factura\s+n[º°o]\.?|c[óo]digo\s+de\s+factura)'
+        r'\s*[:.#]?\s*([A-Z0-9][A-Z0-9/_.-]{3,})'
+    )
+    for match in re.finditer(pattern, text, re.IGNORECASE):
+        number = match.group(1).rstrip('.-')
+        if re.search(r'\d', number):
+            return number
+    return None
+
+# Función para buscar la fecha de emisión de la factura en las líneas que la mencionan
+def find_invoice_date(lines):
+    for index, line in enumerate(lines):
+        lower = line.lower()
+        if 'fecha' in lower and ('factura' in lower or 'emisi' in lower or 'expedici' in lower):
+            # La fecha puede estar en la misma línea o en la siguiente (tablas)
+            for candidate in (line, lines[index + 1] if index + 1 < len(lines) else ''):
+                dates = find_dates(candidate)
+                if dates:
+                    return dates[0].strftime('%d/%m/%Y')
+    return None
+
+# Función para cargar el manifiesto de archivos ya procesados (vacío si todavía no existe)
+def load_manifest(path):
+    if not os.path.isfile(path):
+        return {}
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+# Función para guardar el manifiesto de forma atómica (archivo temporal + renombrado)
+def save_manifest(manifest, path):
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, ensure_ascii=False, indent=2)
+    os.replace(temporary_path, path)
+
+# Función para obtener tamaño, fecha de modificación y hash de un PDF
+# (si tamaño y fecha no han cambiado se reutiliza el hash del manifiesto sin volver a leer el archivo)
+def get_file_fingerprint(pdf_path, entry=None):
+    stat = os.stat(pdf_path)
+    fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if entry and entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+        fingerprint['hash'] = entry['hash']
+    else:
+        fingerprint['hash'] = file_sha256(pdf_path)
+    return fingerprint
+
+# Función para decidir si un PDF hay que procesarlo: es nuevo, su contenido ha cambiado,
+# ha cambiado la versión del pipeline o la última vez terminó con error
+def needs_processing(entry, fingerprint, version):
+    return not (
+        entry
+        and entry.get('status') == 'done'
+        and entry.get('hash') == fingerprint['hash']
+        and entry.get('pipeline_version') == version
+    )
+
+# Función para eliminar filas repetidas del CSV, conservando la última fila de cada archivo
+# (key_field es la columna con el nombre del archivo, distinta en cada script)
+def dedupe_csv(csv_file_path, key_field):
+    if not os.path.isfile(csv_file_path):
+        return
+    with open(csv_file_path, newline='', encoding='utf-8') as csv_file:
+        reader = csv.DictReader(csv_file)
+        fieldnames = reader.fieldnames
+        rows = list(reader)
+
+    latest_rows = {}
+    for row in rows:
+        latest_rows.pop(row.get(key_field), None)  # La fila más reciente pasa al final
+        latest_rows[row.get(key_field)] = row
+    if len(latest_rows) == len(rows):
+        return
+
+    temporary_path = csv_file_path + '.tmp'
+    with open(temporary_path, 'w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(latest_rows.values())
+    os.replace(temporary_path, csv_file_path)
+    print(f"Eliminadas {len(rows) - len(latest_rows)} filas repetidas del CSV")
+
+# Campos que se extraen de cada factura (los define cada script)
+invoice_fields = []
+
+# Clave API y URL del endpoint de Ollama
+api_key = 'ollama'
+api_url = 'http://localhost:11434/api/generate'
+
+# Ventana de contexto (num_ctx) de Ollama
+# (el modelo, las cachés y las peticiones en paralelo son ajustes de factalia_common: configure los reenvía)
+llm_num_ctx = 4096
+
+# Lectura en streaming de la respuesta con los campos y tokens máximos generados para esa respuesta
+use_streaming = True
+extraction_num_predict = 250
+
+# Función para cambiar la configuración del módulo (campos, endpoint, streaming...)
+# Los ajustes de factalia_common (modelo, cachés, peticiones en paralelo) se le reenvían;
+# cualquier otro nombre que no sea una variable del módulo lanza ValueError
+def configure(**settings):
+    unknown = [
+        name for name in settings if name not in factalia_common.SETTINGS
+        and (name not in globals() or name.isupper() or callable(globals()[name]))
+    ]
+    if unknown:
+        raise ValueError(f"Configuración desconocida: {unknown}")
+    factalia_common.configure(**{name: value for name, value in settings.items() if name in factalia_common.SETTINGS})
+    globals().update({name: value for name, value in settings.items() if name not in factalia_common.SETTINGS})
@@ -0,0 +1,1530 @@
+# Pipeline condivisa dagli script di estrazione delle fatture da immagini (OCR + Ollama).
+# Ogni script definisce solo i campi, i prompt, il modello e i percorsi e li passa a configure;
+# tutte le altre impostazioni hanno qui il loro valore predefinito e possono essere cambiate allo stesso modo.
+import os
+import re
+import sys
+import csv
+import json
+import requests
+import pdfplumber
+from paddleocr import PaddleOCR
+from pdf2image import convert_from_path
+import fitz  # PyMuPDF
+import numpy as np
+import cv2  # OpenCV (dipendenza di PaddleOCR)
+import shutil  # Per spostare i file
+import threading
+import time
+import resource
+import queue
+import multiprocessing
+from concurrent.futures import Future, InvalidStateError, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+
+# Funzioni comuni a tutti gli script (hash, cache, token, Ollama, schema dei campi): factalia_common.py,
+# nella cartella Factalia
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import factalia_common
+from factalia_common import (
+    file_sha256, text_cache_key, text_cache_get, text_cache_put, text_cache_stats, get_chars_per_token,
+    estimate_tokens, split_lines, fit_prompt, record_token_usage, token_stats, get_ollama_session,
+    read_stream_until_fields, check_ollama_response, build_fields_schema, validate_fields_response
+)
+
+# Motore PaddleOCR del processo corrente: viene caricato una sola volta e poi riutilizzato
+ocr_engine = None
+
+# Con ocr_workers = 0 l'OCR avviene nel processo principale: i thread della fase "testo" condividono
+# lo stesso motore e lo usano uno alla volta
+in_process_ocr_lock = threading.Lock()
+
+# Funzione per ottenere il motore OCR del processo (lo crea solo alla prima chiamata)
+def get_ocr_engine():
+    global ocr_engine
+    if ocr_engine is None:
+        ocr_engine = PaddleOCR(
+            use_angle_cls=True, lang='es',  # Usa la lingua spagnola
+            cpu_threads=ocr_cpu_threads, rec_batch_num=ocr_rec_batch_num
+        )
+    return ocr_engine
+
+# Funzione eseguita all'avvio di ogni worker: applica le impostazioni del processo principale
+# e carica subito detector e recognizer così restano "caldi"
+def init_ocr_worker(settings):
+    configure(**settings)
+    get_ocr_engine()
+
+# Funzione per eseguire l'OCR nel processo principale (senza pool), un thread alla volta
+def run_ocr_in_process(function, *args):
+    with in_process_ocr_lock:
+        return function(*args)
+
+# Funzione per calcolare quanti core sono disponibili per il processo
+def get_available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+# Contatori del worker OCR corrente (vivono nel processo worker e vengono inviati con ogni risultato)
+worker_counters = {'tasks': 0, 'documents': 0, 'last_document': None}
+
+# Funzione eseguita nei worker per ogni task: esegue la funzione richiesta e aggiorna i contatori del worker
+def run_ocr_task(document, function, *args):
+    result = function(*args)
+    worker_counters['tasks'] += 1
+    if document is not None and document != worker_counters['last_document']:
+        worker_counters['documents'] += 1
+        worker_counters['last_document'] = document
+    rss_mb, _ = get_process_memory()
+    return result, {
+        'pid': os.getpid(),
+        'tasks': worker_counters['tasks'],
+        'documents': worker_counters['documents'],
+        'rss_mb': rss_mb
+    }
+
+# Funzione eseguita sui nuovi worker durante il riciclo: il modello è già caricato dall'initializer,
+# la breve attesa tiene occupato il worker così che ogni task di warm-up finisca su un processo diverso
+def warm_up_ocr_worker():
+    get_ocr_engine()
+    time.sleep(0.2)
+    return os.getpid()
+
+# Funzione per creare un executor di worker OCR. I processi vengono avviati con 'spawn' e non con fork:
+# il pool viene sostituito da un thread mentre altri thread (pipeline, lotti, Ollama) sono attivi,
+# e un fork di un processo multi-thread può ereditare lock presi da quei thread.
+# Le impostazioni passate a configure arrivano ai worker tramite l'initializer
+def create_ocr_executor(max_workers):
+    return ProcessPoolExecutor(
+        max_workers=max_workers, initializer=init_ocr_worker, initargs=(configured_settings,),
+        mp_context=multiprocessing.get_context('spawn')
+    )
+
+# Funzione per creare il pool di worker OCR, dimensionato sui core disponibili
+# Il pool è uno stato condiviso: l'executor corrente viene sostituito quando i worker vanno riciclati
+@contextmanager
+def create_ocr_pool(max_workers=None):
+    if max_workers is None:
+        max_workers = ocr_workers or get_available_cores()
+    print(f"Avvio del pool OCR con {max_workers} worker...")
+    ocr_pool = {
+        'executor': create_ocr_executor(max_workers),
+        'max_workers': max_workers,
+        'generation': 1,
+        'replacing': False,
+        'closed': False,
+        'workers': {},
+        'lock': threading.Lock(),
+        'rec_requests': queue.Queue(),
+        'rec_batcher_error': None
+    }
+    # Con use_batched_ocr ogni pool ha il suo thread che forma i lotti di riconoscimento (vedi submit_crops)
+    rec_batcher = None
+    if use_batched_ocr:
+        rec_batcher = threading.Thread(target=run_rec_batcher, args=(ocr_pool,), daemon=True)
+        rec_batcher.start()
+    try:
+        yield ocr_pool
+    finally:
+        if rec_batcher is not None:
+            ocr_pool['rec_requests'].put(REC_BATCHER_STOP)
+            rec_batcher.join()
+        with ocr_pool['lock']:
+            ocr_pool['closed'] = True
+            executor = ocr_pool['executor']
+        executor.shutdown(wait=True)
+        print_ocr_pool_stats(ocr_pool)
+
+# Funzione per inviare un task al pool OCR; document identifica il PDF a cui appartiene (None se misto)
+# Restituisce un Future con il solo risultato: i contatori del worker vengono registrati nel pool.
+# Annullando il Future si annulla anche il task, se il worker non l'ha ancora iniziato
+def submit_ocr_task(ocr_pool, document, function, *args):
+    future = Future()
+    with ocr_pool['lock']:
+        generation = ocr_pool['generation']
+        task = ocr_pool['executor'].submit(run_ocr_task, document, function, *args)
+
+    def on_done(task):
+        if task.cancelled():
+            future.cancel()
+            return
+        try:
+            if task.exception() is not None:
+                future.set_exception(task.exception())
+                return
+            result, worker = task.result()
+            record_ocr_worker(ocr_pool, dict(worker, generation=generation))
+            future.set_result(result)
+        except InvalidStateError:
+            pass  # Future già annullato (documento omesso): il risultato non serve più
+
+    task.add_done_callback(on_done)
+    future.add_done_callback(lambda future: task.cancel() if future.cancelled() else None)
+    return future
+
+# Funzione per registrare i contatori di un worker e decidere se è ora di riciclare il pool
+def record_ocr_worker(ocr_pool, worker):
+    with ocr_pool['lock']:
+        ocr_pool['workers'][worker['pid']] = worker
+        current = worker['generation'] == ocr_pool['generation']
+    if not current:
+        return
+    if worker_recycle_documents and worker['documents'] >= worker_recycle_documents:
+        recycle_ocr_pool(ocr_pool, f"worker {worker['pid']}: {worker['documents']} documentos")
+    elif worker_recycle_rss_mb and worker['rss_mb'] >= worker_recycle_rss_mb:
+        recycle_ocr_pool(ocr_pool, f"worker {worker['pid']}: {worker['rss_mb']:.0f} MB")
+
+# Funzione per avviare il riciclo dei worker OCR (una sola sostituzione alla volta)
+# ProcessPoolExecutor non permette di sostituire un singolo processo, quindi si sostituisce l'intero pool
+def recycle_ocr_pool(ocr_pool, reason):
+    with ocr_pool['lock']:
+        if ocr_pool['replacing'] or ocr_pool['closed']:
+            return
+        ocr_pool['replacing'] = True
+    print(f"Reciclando los workers OCR ({reason})...")
+    threading.Thread(target=replace_ocr_executor, args=(ocr_pool,), daemon=True).start()
+
+# Funzione per sostituire l'executor OCR: i nuovi worker vengono avviati e caricati mentre quelli vecchi
+# continuano a lavorare; poi i nuovi task passano al nuovo executor e il vecchio termina quelli già ricevuti
+def replace_ocr_executor(ocr_pool):
+    new_executor = create_ocr_executor(ocr_pool['max_workers'])
+    wait([new_executor.submit(warm_up_ocr_worker) for _ in range(ocr_pool['max_workers'])])
+
+    with ocr_pool['lock']:
+        old_executor = ocr_pool['executor']
+        if not ocr_pool['closed']:
+            ocr_pool['executor'] = new_executor
+            ocr_pool['generation'] += 1
+        ocr_pool['replacing'] = False
+        closed = ocr_pool['closed']
+
+    if closed:
+        new_executor.shutdown(wait=True)
+        return
+    old_executor.shutdown(wait=False)
+
+# Funzione per stampare i contatori dei worker OCR (anche di quelli già riciclati)
+def print_ocr_pool_stats(ocr_pool):
+    print(f"\nWorkers OCR (generaciones: {ocr_pool['generation']}):")
+    for worker in sorted(ocr_pool['workers'].values(), key=lambda worker: (worker['generation'], worker['pid'])):
+        print(
+            f"  PID {worker['pid']} (generación {worker['generation']}): {worker['documents']} documentos, "
+            f"{worker['tasks']} tareas, RSS {worker['rss_mb']:.0f} MB"
+        )
+
+# Funzione per estrarre testo da una singola immagine usando PaddleOCR
+# L'immagine è già un array NumPy BGR (o in scala di grigi) come lo produce render_pages: nessuna conversione
+def extract_text_from_image(image_np):
+    ocr = get_ocr_engine()
+    result = ocr.ocr(image_np)
+    
+    extracted_text = []
+    for line in result[0] or []:  # result[0] è None se la pagina non contiene testo
+        text = line[1][0]
+        extracted_text.append(text)
+        
+    return ' '.join(extracted_text)
+
+# Funzione per convertire la pagina BGR in scala di grigi (pesi BT.601 in aritmetica intera)
+def to_grayscale(image_np):
+    if image_np.ndim == 2:
+        return image_np
+    gray = image_np[..., 0].astype(np.uint16) * 29  # B, G, R in 1/256
+    gray += image_np[..., 1].astype(np.uint16) * 150
+    gray += image_np[..., 2].astype(np.uint16) * 77
+    return (gray >> 8).astype(np.uint8)
+
+# Funzione per stimare l'altezza tipica delle righe di testo in pixel (mediana delle fasce di righe con inchiostro)
+# Il profilo si calcola su strisce verticali strette, così un'eventuale inclinazione non fonde righe vicine
+def estimate_text_height(gray, strips=8):
+    height, width = gray.shape
+    strip_width = max(width // strips, 1)
+    strips = width // strip_width
+    ink = (gray[:, :strips * strip_width] < 128).reshape(height, strips, strip_width)
+    ink_rows = (ink.mean(axis=2) > 0.01).astype(np.int8).T  # Una riga per striscia
+    edges = np.diff(ink_rows, prepend=0, append=0, axis=1).ravel()
+    heights = np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+    heights = heights[heights >= 3]  # Scarta rumore e righe di tabella
+    return int(np.median(heights)) if heights.size else 0
+
+# Funzione per ridurre la pagina di un fattore intero finché il testo resta alto almeno target_text_height px
+# La riduzione è una media a blocchi (fattore x fattore), calcolata con un reshape senza cicli
+def downscale_to_text_height(image_np):
+    gray = to_grayscale(image_np)
+    factor = estimate_text_height(gray) // target_text_height
+    if factor < 2:
+        return gray
+    height = gray.shape[0] // factor * factor
+    width = gray.shape[1] // factor * factor
+    blocks = gray[:height, :width].reshape(height // factor, factor, width // factor, factor)
+    return (blocks.sum(axis=(1, 3), dtype=np.uint32) // (factor * factor)).astype(np.uint8)
+
+# Funzione per binarizzare la pagina con la soglia di Otsu calcolata sull'istogramma
+def binarize(image_np):
+    gray = to_grayscale(image_np)
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    weight_bg = np.cumsum(hist)
+    weight_fg = weight_bg[-1] - weight_bg
+    sum_bg = np.cumsum(hist * np.arange(256))
+    mean_bg = sum_bg / np.maximum(weight_bg, 1)
+    mean_fg = (sum_bg[-1] - sum_bg) / np.maximum(weight_fg, 1)
+    threshold = int(np.argmax(weight_bg * weight_fg * (mean_bg - mean_fg) ** 2))
+    return np.where(gray > threshold, 255, 0).astype(np.uint8)
+
+# Funzione per stimare l'inclinazione del testo in gradi: per ogni angolo candidato si inclinano i pixel scuri
+# e si sceglie l'angolo con il profilo orizzontale più "appuntito" (righe di testo allineate)
+def find_skew_angle(gray):
+    ys, xs = np.nonzero(gray < 128)
+    if ys.size == 0:
+        return 0.0
+    if ys.size > deskew_max_points:
+        # Campione casuale (riproducibile): un passo fisso creerebbe aliasing con la larghezza delle righe
+        sample = np.random.default_rng(0).integers(0, ys.size, deskew_max_points)
+        ys, xs = ys[sample], xs[sample]
+
+    angles = np.arange(-max_deskew_angle, max_deskew_angle + deskew_angle_step / 2, deskew_angle_step)
+    shifted = np.rint(ys[None, :] - xs[None, :] * np.tan(np.radians(angles))[:, None]).astype(np.int64)
+    shifted -= shifted.min(axis=1, keepdims=True)
+    span = int(shifted.max()) + 1
+    profiles = np.bincount(
+        (shifted + np.arange(len(angles))[:, None] * span).ravel(), minlength=len(angles) * span
+    ).reshape(len(angles), span)
+    return float(angles[int(np.argmax(np.square(profiles).sum(axis=1)))])
+
+# Funzione per raddrizzare la pagina: ogni colonna viene traslata in verticale (shear, adatto ad angoli piccoli)
+def deskew(image_np):
+    gray = to_grayscale(image_np)
+    angle = find_skew_angle(gray)
+    if angle == 0:
+        return gray
+
+    height, width = gray.shape
+    offsets = np.rint(np.arange(width) * np.tan(np.radians(angle))).astype(np.int32)
+    pad = int(offsets.max())
+    new_height = height + pad - int(offsets.min())
+    source_rows = np.arange(new_height, dtype=np.int32)[:, None] - pad + offsets[None, :]
+    valid = (source_rows >= 0) & (source_rows < height)
+    deskewed = gray[np.clip(source_rows, 0, height - 1), np.arange(width, dtype=np.int32)[None, :]]
+    deskewed[~valid] = 255  # Le zone scoperte dalla traslazione diventano bianche
+    return deskewed
+
+# Funzione per ritagliare i margini bianchi e le bande nere di scansione intorno al contenuto
+def crop_borders(image_np):
+    gray = to_grayscale(image_np)
+    ink = gray < 128
+    row_ink = ink.mean(axis=1)
+    col_ink = ink.mean(axis=0)
+    rows = np.flatnonzero((row_ink > 0) & (row_ink < max_border_ink))
+    cols = np.flatnonzero((col_ink > 0) & (col_ink < max_border_ink))
+    if rows.size == 0 or cols.size == 0:
+        return gray
+    top, bottom = max(rows[0] - crop_margin, 0), rows[-1] + crop_margin + 1
+    left, right = max(cols[0] - crop_margin, 0), cols[-1] + crop_margin + 1
+    return gray[top:bottom, left:right]
+
+# Passi di preprocessing disponibili, nell'ordine in cui possono essere configurati in preprocessing_steps
+PREPROCESSING_STEPS = {
+    'grayscale': to_grayscale,
+    'downscale': downscale_to_text_height,
+    'binarize': binarize,
+    'deskew': deskew,
+    'crop': crop_borders
+}
+
+# Funzione per applicare i passi di preprocessing configurati alla pagina, misurando la durata di ognuno (ms)
+def preprocess_page(image_np):
+    timings = {}
+    for step in preprocessing_steps:
+        start = time.perf_counter()
+        image_np = PREPROCESSING_STEPS[step](image_np)
+        timings[step] = (time.perf_counter() - start) * 1000
+    return image_np, timings
+
+# Parole chiave vicino alle quali si trovano i campi da estrarre (dati della fattura, dati fiscali, totali)
+ROI_KEYWORDS = re.compile(
+    r'factura|fecha|c\.?i\.?f|n\.?i\.?f|iva|total|base\s+imponible|subtotal|importe', re.IGNORECASE
+)
+
+# Formati di CIF, NIF e NIE, usati per riconoscere il fornitore e associargli le regioni apprese
+TAX_ID_PATTERN = re.compile(r'[A-HJ-NP-SUVW]\d{7}[0-9A-J]|\d{8}[A-Z]|[XYZ]\d{7}[A-Z]')
+
+# Funzione per trovare i CIF/NIF presenti in un testo (ignorando spazi, punti e trattini)
+def find_tax_ids(text):
+    return TAX_ID_PATTERN.findall(re.sub(r'[\s.\-]', '', text.upper()))
+
+# Funzione per rilevare le righe di testo della pagina (solo detection, senza riconoscimento)
+# Restituisce i rettangoli (x0, y0, x1, y1) in ordine di lettura
+def detect_text_lines(image_np):
+    result = get_ocr_engine().ocr(image_np, rec=False, cls=False)
+    boxes = []
+    for box in result[0] or []:
+        xs = [point[0] for point in box]
+        ys = [point[1] for point in box]
+        boxes.append((max(int(min(xs)), 0), max(int(min(ys)), 0), int(max(xs)) + 1, int(max(ys)) + 1))
+    return sorted(boxes, key=lambda box: (box[1], box[0]))
+
+# Funzione per riconoscere il testo delle righe indicate, ritagliate dalla pagina come viste (senza copie), in un solo lotto
+def recognize_lines(image_np, boxes):
+    return recognize_crops([image_np[y0:y1, x0:x1] for x0, y0, x1, y1 in boxes])
+
+# Funzione per scegliere le righe il cui centro cade in una delle fasce verticali (frazioni dell'altezza pagina)
+def lines_in_bands(boxes, page_height, bands):
+    return [
+        index for index, (x0, y0, x1, y1) in enumerate(boxes)
+        if any(top <= (y0 + y1) / 2 / page_height <= bottom for top, bottom in bands)
+    ]
+
+# Funzione per l'OCR delle sole regioni utili. La detection gira su tutta la pagina (è la parte economica),
+# il riconoscimento solo sulle righe delle fasce di intestazione e totali, su quelle vicine alle parole chiave
+# e su quelle delle fasce apprese per il fornitore (riconosciuto dal CIF/NIF letto nelle righe precedenti).
+# Restituisce il testo in ordine di lettura e le righe riconosciute con la loro posizione verticale normalizzata.
+def extract_text_from_image_roi(image_np, profiles=None):
+    boxes = detect_text_lines(image_np)
+    page_height = image_np.shape[0]
+    texts = {}
+
+    def recognize(indices):
+        indices = [index for index in indices if index not in texts]
+        for index, text in zip(indices, recognize_lines(image_np, [boxes[index] for index in indices])):
+            texts[index] = text
+
+    recognize(lines_in_bands(boxes, page_height, roi_default_bands))
+
+    anchors = [boxes[index] for index, text in texts.items() if ROI_KEYWORDS.search(text)]
+    distance = roi_anchor_distance * page_height
+    recognize([
+        index for index, box in enumerate(boxes)
+        if any(abs(box[1] - anchor[1]) <= distance for anchor in anchors)
+    ])
+
+    for tax_id in find_tax_ids(' '.join(texts.values())):
+        if profiles and tax_id in profiles:
+            recognize(lines_in_bands(boxes, page_height, profiles[tax_id]))
+            break
+
+    print(f"ROI: {len(texts)} de {len(boxes)} líneas reconocidas")
+    order = sorted(texts)
+    lines = [
+        {'text': texts[index], 'top': boxes[index][1] / page_height, 'bottom': boxes[index][3] / page_height}
+        for index in order
+    ]
+    return ' '.join(texts[index] for index in order), lines
+
+# Profili ROI appresi: per ogni fornitore (CIF/NIF) le fasce verticali in cui sono stati trovati i suoi campi
+roi_profiles = None
+roi_profiles_lock = threading.Lock()
+
+# Funzione per ottenere i profili ROI (letti dal file solo alla prima chiamata)
+def get_roi_profiles():
+    global roi_profiles
+    with roi_profiles_lock:
+        if roi_profiles is None:
+            roi_profiles = {}
+            if os.path.isfile(roi_profiles_path):
+                with open(roi_profiles_path, encoding='utf-8') as file:
+                    roi_profiles = {
+                        tax_id: [tuple(band) for band in bands]
+                        for tax_id, bands in json.load(file).items()
+                    }
+    return roi_profiles
+
+# Funzione per imparare dove si trovano i campi di un fornitore: le righe OCR che contengono i valori estratti
+# diventano fasce da riconoscere sempre nelle prossime fatture dello stesso CIF/NIF
+def learn_roi_profile(lines, extracted_info):
+    tax_ids = find_tax_ids(extracted_info.get(cif_field, ''))
+    if not lines or not tax_ids:
+        return
+
+    values = [
+        re.sub(r'[^A-Z0-9]', '', value.upper())
+        for field, value in extracted_info.items()
+        if field in invoice_fields and value != 'No disponible'
+    ]
+    values = [value for value in values if len(value) >= 3]
+    bands = {
+        (round(max(line['top'] - roi_band_margin, 0.0), 3), round(min(line['bottom'] + roi_band_margin, 1.0), 3))
+        for line in lines
+        if any(value in re.sub(r'[^A-Z0-9]', '', line['text'].upper()) for value in values)
+    }
+    if not bands:
+        return
+
+    profiles = get_roi_profiles()
+    with roi_profiles_lock:
+        profiles[tax_ids[0]] = sorted(set(profiles.get(tax_ids[0], [])) | bands)
+        with open(roi_profiles_path, 'w', encoding='utf-8') as file:
+            json.dump(profiles, file, ensure_ascii=False, indent=2)
+
+# Funzione per ritagliare le righe rilevate in array compatti (da inviare a un altro processo o al recognizer)
+def crop_lines(image_np, boxes):
+    return [np.ascontiguousarray(image_np[y0:y1, x0:x1]) for x0, y0, x1, y1 in boxes]
+
+# Funzione per riconoscere un lotto di ritagli di riga con un'unica chiamata al recognizer di PaddleOCR
+# (il recognizer li ordina per proporzioni e li elabora a gruppi di ocr_rec_batch_num).
+# Classifier e recognizer accettano solo immagini a 3 canali: i ritagli di una pagina in scala di grigi
+# (render_grayscale o preprocessing) vengono convertiti qui, nel worker, così i ritagli inviati restano compatti
+def recognize_crops(crops):
+    if not crops:
+        return []
+    crops = [cv2.cvtColor(crop, cv2.COLOR_GRAY2BGR) if crop.ndim == 2 else crop for crop in crops]
+    ocr = get_ocr_engine()
+    if ocr.use_angle_cls:
+        crops, _, _ = ocr.text_classifier(crops)
+    rec_res, _ = ocr.text_recognizer(crops)
+    return [text for text, score in rec_res]
+
+# Errore sollevato quando una pagina supererebbe max_worker_memory_mb: è un MemoryError "previsto",
+# distinto da un vero esaurimento della memoria (che non va trattato come pagina o documento da omettere)
+class PageMemoryLimitExceeded(MemoryError):
+    pass
+
+# Funzione per controllare che il worker non superi il tetto di memoria prima di elaborare la pagina
+def check_worker_memory(image_np):
+    if max_worker_memory_mb:
+        rss_mb, _ = get_process_memory()
+        needed_mb = image_np.nbytes * ocr_memory_factor / (1024 * 1024)
+        if rss_mb + needed_mb > max_worker_memory_mb:
+            raise PageMemoryLimitExceeded(
+                f"servirebbero ~{rss_mb + needed_mb:.0f} MB per {image_np.shape[1]}x{image_np.shape[0]} px "
+                f"(limite {max_worker_memory_mb} MB)"
+            )
+
+# Funzione per leggere la memoria residente (RSS) attuale e di picco del processo, in MB
+def get_process_memory():
+    try:
+        with open('/proc/self/status') as status:
+            values = dict(line.split(':', 1) for line in status)
+        return int(values['VmRSS'].split()[0]) / 1024, int(values['VmHWM'].split()[0]) / 1024
+    except (OSError, KeyError):
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return peak_mb, peak_mb
+
+# Funzione per azzerare il picco di RSS del processo (solo Linux), così da misurarlo pagina per pagina
+def reset_peak_memory():
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+# Funzione eseguita dai worker OCR: controlla il tetto di memoria, riconosce la pagina e misura il picco di RSS
+# Se il worker supererebbe max_worker_memory_mb solleva PageMemoryLimitExceeded prima di avviare l'OCR.
+# Con use_preprocessing la pagina passa prima dai passi di preprocessing; restituisce anche i loro tempi.
+# Con use_roi_ocr si riconoscono solo le regioni utili e si restituiscono anche le righe lette;
+# con use_batched_ocr tutte le righe della pagina vengono riconosciute in un unico lotto.
+def ocr_page(image_np, profiles=None):
+    check_worker_memory(image_np)
+    reset_peak_memory()
+    timings = {}
+    if use_preprocessing:
+        image_np, timings = preprocess_page(image_np)
+    lines = []
+    if use_roi_ocr:
+        text, lines = extract_text_from_image_roi(image_np, profiles)
+    elif use_batched_ocr:
+        text = ' '.join(recognize_crops(crop_lines(image_np, detect_text_lines(image_np))))
+    else:
+        text = extract_text_from_image(image_np)
+    return text, get_process_memory()[1], timings, lines
+
+# Funzione eseguita dai worker OCR in modalità batch: solo detection, restituisce i ritagli delle righe
+# che verranno riconosciuti insieme a quelli di altre pagine e documenti (vedi submit_crops)
+def detect_page(image_np):
+    check_worker_memory(image_np)
+    reset_peak_memory()
+    timings = {}
+    if use_preprocessing:
+        image_np, timings = preprocess_page(image_np)
+    crops = crop_lines(image_np, detect_text_lines(image_np))
+    return crops, get_process_memory()[1], timings
+
+# Segnale di arresto per il thread dei lotti, inviato quando il pool OCR viene chiuso
+REC_BATCHER_STOP = object()
+
+# Funzione che forma i lotti di riconoscimento: unisce i ritagli delle richieste arrivate finché il lotto
+# raggiunge ocr_rec_batch_size ritagli o passano ocr_batch_wait secondi, poi lo invia al pool OCR
+# e restituisce a ogni richiesta i testi dei suoi ritagli, nello stesso ordine.
+# Si ferma con REC_BATCHER_STOP; se fallisce, le richieste in attesa e le successive ricevono l'errore
+def run_rec_batcher(ocr_pool):
+    requests_queue = ocr_pool['rec_requests']
+    batch = []
+    try:
+        stopping = False
+        while not stopping:
+            request = requests_queue.get()
+            if request is REC_BATCHER_STOP:
+                break
+            batch = [request]
+            batch_crops = len(request['crops'])
+            deadline = time.monotonic() + ocr_batch_wait
+            while batch_crops < ocr_rec_batch_size:
+                try:
+                    request = requests_queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if request is REC_BATCHER_STOP:
+                    stopping = True  # Si invia comunque il lotto già formato
+                    break
+                batch.append(request)
+                batch_crops += len(request['crops'])
+
+            crops = [crop for request in batch for crop in request['crops']]
+            future = submit_ocr_task(ocr_pool, None, recognize_crops, crops)
+            future.add_done_callback(lambda future, batch=batch: distribute_rec_batch(future, batch))
+            batch = []
+    except Exception as e:
+        print(f"Error en el hilo de lotes de reconocimiento: {e}")
+        with ocr_pool['lock']:
+            ocr_pool['rec_batcher_error'] = e
+            while True:
+                try:
+                    request = requests_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is not REC_BATCHER_STOP:
+                    batch.append(request)
+        for request in batch:
+            request['future'].set_exception(e)
+
+# Funzione per distribuire i testi di un lotto alle richieste che lo compongono
+def distribute_rec_batch(future, batch):
+    if future.exception() is not None:
+        for request in batch:
+            request['future'].set_exception(future.exception())
+        return
+    texts = future.result()
+    start = 0
+    for request in batch:
+        request['future'].set_result(texts[start:start + len(request['crops'])])
+        start += len(request['crops'])
+
+# Funzione per chiedere il riconoscimento di ritagli di riga: restituisce un Future con i testi nello stesso ordine
+# Le richieste vanno al thread dei lotti del pool, avviato e fermato da create_ocr_pool
+def submit_crops(ocr_pool, crops):
+    future = Future()
+    if not crops:
+        future.set_result([])
+    else:
+        with ocr_pool['lock']:
+            error = ocr_pool['rec_batcher_error']
+            if error is None:
+                ocr_pool['rec_requests'].put({'crops': crops, 'future': future})
+        if error is not None:
+            future.set_exception(error)
+    return future
+
+# Funzione per completare una pagina in modalità batch: quando la detection termina i ritagli passano
+# al riconoscimento a lotti. Restituisce un Future con (testo, picco RSS, tempi, righe) come ocr_page
+def recognize_detected_page(ocr_pool, detection):
+    page_future = Future()
+
+    def on_recognized(texts_future, peak_mb, timings):
+        try:
+            if texts_future.exception() is not None:
+                page_future.set_exception(texts_future.exception())
+            else:
+                page_future.set_result((' '.join(texts_future.result()), peak_mb, timings, []))
+        except InvalidStateError:
+            pass  # Pagina annullata mentre i ritagli erano in riconoscimento
+
+    def on_detected(detection):
+        if detection.cancelled() or page_future.cancelled():
+            page_future.cancel()
+            return
+        if detection.exception() is not None:
+            page_future.set_exception(detection.exception())
+            return
+        crops, peak_mb, timings = detection.result()
+        submit_crops(ocr_pool, crops).add_done_callback(
+            lambda texts_future: on_recognized(texts_future, peak_mb, timings)
+        )
+
+    detection.add_done_callback(on_detected)
+    # Annullando la pagina si annulla la detection, se non è ancora iniziata
+    page_future.add_done_callback(lambda page_future: detection.cancel() if page_future.cancelled() else None)
+    return page_future
+
+# Funzione per valutare la qualità del livello di testo di una pagina:
+# numero di caratteri utili e percentuale di caratteri "spazzatura" (glifi non mappati, simboli strani)
+def score_text_layer(text):
+    unmapped_chars = sum(len(match) for match in re.findall(r'\(cid:\d+\)', text))
+    text = re.sub(r'\(cid:\d+\)', '', text)
+    chars = ''.join(text.split())
+    if not chars and not unmapped_chars:
+        return {'chars': 0, 'garbage_ratio': 1.0}
+
+    garbage = unmapped_chars + sum(
+        1 for char in chars if not (char.isalnum() or char in TEXT_LAYER_SYMBOLS)
+    )
+    return {'chars': len(chars), 'garbage_ratio': garbage / (len(chars) + unmapped_chars)}
+
+# Funzione per decidere se il livello di testo è sufficiente o se la pagina va passata all'OCR
+def is_text_layer_usable(score):
+    return score['chars'] >= min_text_layer_chars and score['garbage_ratio'] <= max_text_layer_garbage
+
+# Parole chiave che indicano una pagina con i campi da estrarre, con il loro peso nel punteggio della pagina
+PAGE_KEYWORDS = {
+    r'factura': 3,
+    r'fecha': 1,
+    r'cliente|titular': 1,
+    r'\bc\.?i\.?f\b|\bn\.?i\.?f\b': 2,
+    r'base\s+imponible|imponible': 3,
+    r'\biva\b': 2,
+    r'\btotal\b': 3,
+    r'importe|subtotal': 1
+}
+AMOUNT_PATTERN = re.compile(r'\d+[.,]\d{2}(?!\d)')
+
+# Funzione per stimare quanto è probabile che una pagina contenga i campi richiesti
+# (parole chiave, importi e CIF/NIF, senza chiamare il LLM)
+def score_page_fields(text):
+    score = sum(weight for pattern, weight in PAGE_KEYWORDS.items() if re.search(pattern, text, re.IGNORECASE))
+    score += 0.5 * min(len(AMOUNT_PATTERN.findall(text)), 10)
+    score += 2 * min(len(set(find_tax_ids(text))), 2)
+    return score
+
+# Funzione per leggere con l'OCR una miniatura a bassa risoluzione delle pagine senza livello di testo
+# (il testo serve solo a calcolare il punteggio della pagina, non all'estrazione)
+def read_page_thumbnails(pdf_path, page_numbers, ocr_pool=None):
+    thumbnails = render_pages(
+        pdf_path, page_numbers, dpi=page_thumbnail_dpi, grayscale=True, zero_copy=ocr_pool is None
+    )
+    if ocr_pool is not None:
+        futures = {
+            page_number: submit_ocr_task(ocr_pool, pdf_path, extract_text_from_image, image)
+            for page_number, image in thumbnails
+        }
+        return {page_number: future.result() for page_number, future in futures.items()}
+    return {page_number: run_ocr_in_process(extract_text_from_image, image) for page_number, image in thumbnails}
+
+# Funzione per scegliere le pagine da elaborare quando il documento ne ha più di page_budget:
+# tiene le page_budget pagine con il punteggio più alto (a parità, la prima e l'ultima, poi le prime)
+# e le restituisce in ordine di documento
+def select_pages(pdf_path, pages, ocr_pool=None):
+    if len(pages) <= page_budget:
+        return pages
+
+    scanned_pages = [page['page'] for page in pages if page['method'] == 'ocr']
+    thumbnail_texts = {}
+    if scanned_pages and page_thumbnail_dpi:
+        thumbnail_texts = read_page_thumbnails(pdf_path, scanned_pages, ocr_pool)
+    scores = {page['page']: score_page_fields(thumbnail_texts.get(page['page'], page['text'])) for page in pages}
+
+    edges = (pages[0]['page'], pages[-1]['page'])
+    ranked = sorted(scores, key=lambda number: (-scores[number], number not in edges, number))
+    selected = sorted(ranked[:page_budget])
+    summary = ', '.join(f"{number} ({scores[number]:g})" for number in selected)
+    print(f"Páginas seleccionadas (puntuación): {summary} de {len(pages)} candidatas")
+    return [page for page in pages if page['page'] in selected]
+
+# Funzione per convertire i pixel RGB in BGR, l'ordine dei canali atteso da PaddleOCR
+# La conversione crea un array contiguo con i suoi dati: è l'unica copia della pagina (una vista con i canali
+# invertiti verrebbe comunque copiata da PaddleOCR o nell'invio al worker)
+def to_ocr_layout(image_np):
+    if image_np.ndim == 3:
+        return cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR)
+    return image_np  # Scala di grigi: PaddleOCR la accetta così com'è
+
+# Funzione per rasterizzare solo le pagine richieste (numerate da 1), una alla volta
+# Con PyMuPDF il rendering avviene nel processo, senza lanciare pdftoppm; pdf2image resta come alternativa.
+# Restituisce (numero di pagina, array NumPy) man mano che ogni pagina viene renderizzata.
+# Le pagine a colori vengono lette dal buffer del pixmap e copiate una sola volta nella conversione in BGR.
+# In scala di grigi, con zero_copy l'array è una vista sul buffer del pixmap, valida solo finché non si chiede
+# la pagina successiva; senza zero_copy l'array possiede i suoi dati (serve quando la pagina va inviata
+# a un altro processo).
+def render_pages(pdf_path, page_numbers, dpi=None, grayscale=None, zero_copy=False):
+    dpi = dpi or render_dpi
+    grayscale = render_grayscale if grayscale is None else grayscale
+
+    if render_backend == 'pdf2image':
+        for page_number in page_numbers:
+            image = convert_from_path(
+                pdf_path, dpi=dpi, first_page=page_number, last_page=page_number, grayscale=grayscale
+            )[0]
+            yield page_number, to_ocr_layout(np.asarray(image))
+        return
+
+    with fitz.open(pdf_path) as doc:
+        colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+        for page_number in page_numbers:
+            pix = doc[page_number - 1].get_pixmap(dpi=dpi, colorspace=colorspace, alpha=False)
+            samples = pix.samples_mv if zero_copy or pix.n > 1 else pix.samples
+            shape = (pix.height, pix.width, pix.n) if pix.n > 1 else (pix.height, pix.width)
+            yield page_number, to_ocr_layout(np.frombuffer(samples, dtype=np.uint8).reshape(shape))
+
+# Funzione per descrivere le impostazioni che cambiano il testo estratto (fanno parte della chiave della cache)
+def get_text_settings():
+    return {
+        'pdfplumber': pdfplumber.__version__,
+        'page_selection': [page_budget, page_scan_limit, page_thumbnail_dpi],
+        'min_text_layer_chars': min_text_layer_chars,
+        'max_text_layer_garbage': max_text_layer_garbage,
+        'render': [render_backend, render_dpi, render_grayscale],
+        'preprocessing': [
+            list(preprocessing_steps), target_text_height, max_deskew_angle, deskew_angle_step,
+            max_border_ink, crop_margin
+        ] if use_preprocessing else None,
+        'roi': [roi_default_bands, roi_anchor_distance] if use_roi_ocr else None,
+        'batched_ocr': use_batched_ocr
+    }
+
+# Funzione per estrarre testo dalle pagine del PDF più utili per l'estrazione (al massimo page_budget)
+# Prima prova il livello di testo del PDF (pdfplumber) e rasterizza + OCR solo le pagine che non lo superano.
+# Le pagine vengono scelte per punteggio tra le prime page_scan_limit (più l'ultima), vedi select_pages.
+# Se viene passato un pool OCR le pagine da riconoscere vengono inviate ai worker e processate in parallelo;
+# senza pool (ocr_workers = 0) vengono riconosciute nel processo, leggendo direttamente il buffer del pixmap.
+# Le pagine vengono renderizzate una alla volta e inviate subito all'OCR, senza tenerle tutte in memoria.
+# Con use_roi_ocr le righe lette vengono conservate in roi_lines_by_file per l'apprendimento dei profili ROI.
+# Con max_worker_memory_mb le pagine che supererebbero il tetto vengono saltate ('skipped') o, con 'skip_document',
+# sollevano PageMemoryLimitExceeded, le pagine ancora in coda nel pool vengono annullate e il documento
+# viene omesso (vedi text_stage).
+# Il risultato di ogni pagina resta nella cache di testo: cambiando i prompt si rieseguono solo le fasi LLM.
+# Restituisce il testo e, per ogni pagina, il metodo usato ('text_layer', 'ocr' o 'skipped').
+# file_hash è l'hash SHA-256 del PDF, se già calcolato (ad es. per la chiave del journal).
+def extract_text_from_pdf(pdf_path, ocr_pool=None, file_hash=None):
+    cache_key = text_cache_key(file_hash or file_sha256(pdf_path), 'pdfplumber+paddleocr', get_text_settings())
+    cached_pages = text_cache_get(cache_key)
+    if cached_pages is not None:
+        print(f"Texto de {os.path.basename(pdf_path)} leído de la caché")
+        return ' '.join(page['text'] for page in cached_pages), [page['method'] for page in cached_pages]
+
+    pages = []
+    with pdfplumber.open(pdf_path) as pdf:
+        candidates = pdf.pages
+        if len(candidates) > page_scan_limit:  # Le prime page_scan_limit - 1 pagine più l'ultima
+            candidates = candidates[:page_scan_limit - 1] + candidates[-1:]
+        for page in candidates:
+            text = page.extract_text() or ""
+            score = score_text_layer(text)
+            method = 'text_layer' if is_text_layer_usable(score) else 'ocr'
+            pages.append({'page': page.page_number, 'method': method, 'text': text, **score})
+            page.flush_cache()  # Libera gli oggetti della pagina già letta
+
+    pages = select_pages(pdf_path, pages, ocr_pool)
+    ocr_pages = {page['page']: page for page in pages if page['method'] == 'ocr'}
+    # Senza pool l'OCR avviene nel processo mentre il pixmap è ancora vivo: si legge direttamente dal suo buffer
+    rendered_pages = render_pages(pdf_path, list(ocr_pages), zero_copy=ocr_pool is None)
+    profiles = get_roi_profiles() if use_roi_ocr else None
+
+    futures = {}
+    if ocr_pool is not None and ocr_pages and use_batched_ocr and not use_roi_ocr:
+        # Detection nei worker, riconoscimento a lotti insieme alle righe delle altre pagine e documenti
+        print(f"Procesando {len(ocr_pages)} páginas en el pool OCR (reconocimiento por lotes)...")
+        futures = {
+            page_number: recognize_detected_page(ocr_pool, submit_ocr_task(ocr_pool, pdf_path, detect_page, image))
+            for page_number, image in rendered_pages
+        }
+        results = ((page_number, future.result) for page_number, future in futures.items())
+    elif ocr_pool is not None and ocr_pages:
+        print(f"Procesando {len(ocr_pages)} páginas en el pool OCR...")
+        futures = {
+            page_number: submit_ocr_task(ocr_pool, pdf_path, ocr_page, image, profiles)
+            for page_number, image in rendered_pages
+        }
+        results = ((page_number, future.result) for page_number, future in futures.items())
+    else:
+        # Senza pool ogni pagina viene renderizzata e riconosciuta prima di passare alla successiva
+        results = (
+            (page_number, lambda image=image: run_ocr_in_process(ocr_page, image, profiles))
+            for page_number, image in rendered_pages
+        )
+
+    memory_peaks = []
+    for page_number, get_result in results:
+        page = ocr_pages[page_number]
+        print(f"Procesando página {page_number} con OCR...")
+        try:
+            page['text'], peak_mb, timings, page['lines'] = get_result()
+            memory_peaks.append(peak_mb)
+            if timings:
+                print(f"Preprocesado página {page_number}: " + ", ".join(
+                    f"{step} {elapsed:.0f} ms" for step, elapsed in timings.items()
+                ))
+        except PageMemoryLimitExceeded as e:
+            if memory_limit_policy == 'skip_document':
+                for future in futures.values():  # Le pagine non ancora iniziate non occupano più i worker
+                    future.cancel()
+                raise
+            print(f"Página {page_number} omitida por límite de memoria: {e}")
+            page.update(method='skipped', text='')
+
+    for page in pages:
+        print(
+            f"Página {page['page']}: {page['method']} "
+            f"({page['chars']} caracteres, basura {page['garbage_ratio']:.0%})"
+        )
+
+    if use_roi_ocr:
+        roi_lines_by_file[pdf_path] = [line for page in pages for line in page.get('lines', [])]
+
+    if memory_peaks:
+        print(f"Pico de memoria (RSS) del OCR para {os.path.basename(pdf_path)}: {max(memory_peaks):.0f} MB")
+
+    if all(page['method'] != 'skipped' for page in pages):  # Le pagine saltate non vanno in cache
+        text_cache_put(cache_key, [{'text': page['text'], 'method': page['method']} for page in pages])
+
+    return ' '.join(page['text'] for page in pages), [page['method'] for page in pages]
+
+# Funzione di segmentazione del testo: segmenti di al massimo max_tokens token,
+# tagliati a fine riga quando possibile e altrimenti tra due parole
+def split_text(text, max_tokens):
+    max_chars = max(int(max_tokens * get_chars_per_token(factalia_common.llm_model)), 20)
+    segments, current, current_chars = [], [], 0
+    for line in split_lines(text, max_chars):
+        if current and current_chars + len(line) + 1 > max_chars:
+            segments.append('\n'.join(current).strip())
+            current, current_chars = [], 0
+        current.append(line)
+        current_chars += len(line) + 1
+    if current:
+        segments.append('\n'.join(current).strip())
+    return [segment for segment in segments if segment]
+
+# Funzione per inviare il testo al modello LLaMA 3 e ottenere una risposta formattata
+# Al massimo ollama_num_parallel richieste sono in volo contemporaneamente (vedi OLLAMA_NUM_PARALLEL)
+# Con response_format (schema JSON) Ollama vincola l'output a quello schema; num_predict limita i token generati
+# Con stream_fields la risposta viene letta in streaming e interrotta quando sono arrivati tutti quei campi
+# Se Ollama risponde con un errore solleva requests.HTTPError (vedi check_ollama_response)
+def query_llama_3(api_key, api_url, prompt, response_format=None, num_predict=None, stream_fields=None):
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    
+    payload = {
+        "model": factalia_common.llm_model,
+        "prompt": prompt,
+        "stream": False,
+        "max_tokens": 500,
+        "options": {"num_ctx": llm_num_ctx}
+    }
+    if response_format is not None:
+        payload["format"] = response_format
+    if num_predict is not None:
+        payload["options"]["num_predict"] = num_predict
+   
+    if use_streaming and stream_fields is not None:
+        payload["stream"] = True
+        with factalia_common.ollama_slots:
+            response = get_ollama_session().post(api_url, headers=headers, json=payload, stream=True)
+            check_ollama_response(response)
+            usage = {}
+            response_text = read_stream_until_fields(response, stream_fields, usage)
+        record_token_usage(prompt, usage)
+        return response_text
+
+    with factalia_common.ollama_slots:
+        response = get_ollama_session().post(api_url, headers=headers, json=payload)
+    check_ollama_response(response)
+
+    try:
+        response_json = response.json()
+        if isinstance(response_json, dict) and 'response' in response_json:
+            record_token_usage(prompt, response_json)
+            response_text = response_json['response']
+        elif isinstance(response_json, list):
+            record_token_usage(prompt, response_json[-1] if response_json else {})
+            response_text = ' '.join([res['response'] for res in response_json if 'response' in res])
+        else:
+            response_text = ''
+    except ValueError as e:
+        print(f"Error de decodificación JSON: {e}")
+        response_text = ''
+        
+    return response_text
+
+# Funzione per estrarre le informazioni specifiche dal testo formattato
+# Ollama restituisce un JSON vincolato allo schema dei campi, quindi il parsing è deterministico
+def extract_info_from_text(formatted_text, api_key, api_url, pdf_file_name):
+    prompt_extraction = fit_prompt(lambda text: (
+        "Por favor, responde únicamente con un objeto JSON con las siguientes claves:\n"
+        + "".join(f"- {field}\n" for field in invoice_fields) +
+        "\nLlena cada campo con la información correspondiente, o usa 'No disponible' si no hay información.\n\n"
+        f"Texto formateado:\n{text}\n"
+    ), formatted_text, extraction_token_budget)
+    
+    response = query_llama_3(
+        api_key, api_url, prompt_extraction,
+        response_format=build_fields_schema(invoice_fields),
+        num_predict=extraction_num_predict,
+        stream_fields=invoice_fields
+    )
+
+    info = {field: 'No disponible' for field in invoice_fields}
+    info['Nombre del archivo PDF'] = pdf_file_name
+
+    if response:
+        try:
+            values = validate_fields_response(response, invoice_fields)
+        except ValueError as e:
+            print(f"Risposta non valida per {pdf_file_name}: {e}")
+            values = {}
+
+        for field, value in values.items():
+            value = clean_text(value)  # Usa clean_text per rimuovere i caratteri non desiderati
+            if field == cif_field:
+                value = re.sub(r'[^A-Z0-9]', '', value.upper())  # Conserva solo il CIF/NIF
+            if value:
+                info[field] = value
+
+    return info
+
+# Funzione per rimuovere caratteri non desiderati
+def clean_text(text):
+    # Rimuove apici, virgolette e asterischi
+    text = text.replace('*', '')
+    text = text.replace('"', '')
+    text = text.replace("'", '')
+    return text
+
+# Funzione per rinominare e spostare il file PDF (se il PDF manca ed è già nella cartella di output non fa nulla)
+def rename_and_move_pdf(pdf_path, extracted_info, output_folder):
+    new_file_name = (
+        f"{extracted_info.get('Fecha de factura', 'Fecha_no_disponible')}_"
+        f"{extracted_info.get(company_field, 'Nombre_no_disponible')}_"
+        f"{extracted_info.get('Número de factura', 'Numero_no_disponible')}_"
+        f"{extracted_info.get('TOTAL FACTURA', 'total_no_disponible')}.pdf"
+    )
+    
+    new_file_name = re.sub(r'[<>:"/\\|?*\x00-\x1F]', '', new_file_name)
+    new_file_path = os.path.join(output_folder, new_file_name)
+    
+    if os.path.exists(pdf_path) or not os.path.isfile(new_file_path):
+        shutil.move(pdf_path, new_file_path)
+        print(f"File PDF rinominato e spostato a: {new_file_path}")
+    else:
+        # Ripresa dopo un crash tra lo spostamento e il suo record nel journal: il file è già a destinazione
+        print(f"File PDF già spostato in: {new_file_path}")
+    
+    return new_file_path  # Restituisce il nuovo percorso completo del file PDF
+
+# Funzione per calcolare la chiave di un documento nel journal: hash del contenuto + nome del file
+# Un nuovo PDF che riusa il nome di un documento del journal ha un'altra chiave e non ne eredita le fasi
+def get_journal_key(file_hash, file_name):
+    return f"{file_hash}:{file_name}"
+
+# Funzione per sapere se un documento del journal è completato (riga nel CSV e PDF spostato, oppure omesso)
+def is_journal_document_completed(document):
+    stages = set(document['stages'])
+    return 'skipped' in stages or {'row', 'moved'} <= stages
+
+# Funzione per aprire il journal del batch e ricostruire lo stato dei documenti dalle righe già scritte
+# Ogni riga è un record JSON {"key", "file", "stage", ...}; le fasi sono 'ocr', 'llm', 'row' (riga nel CSV)
+# e 'moved', oppure 'skipped' (fase finale dei documenti omessi per il limite di memoria).
+# All'apertura il journal viene compattato (file temporaneo + rinomina): restano solo i documenti
+# non completati, in un record ciascuno, e senza il testo OCR se i dati sono già stati estratti
+def open_journal(journal_path):
+    documents = {}
+    if os.path.isfile(journal_path):
+        with open(journal_path, 'rb') as journal_file:
+            content = journal_file.read()
+        valid_length = content.rfind(b'\n') + 1  # Ultima riga troncata da un crash: si scarta
+        for line in content[:valid_length].decode('utf-8').splitlines():
+            record = json.loads(line)
+            document = documents.setdefault(record.pop('key'), {'stages': []})
+            document['stages'].extend(record.pop('stages', []))
+            if 'stage' in record:
+                document['stages'].append(record.pop('stage'))
+            document.update(record)
+
+        documents = {
+            key: document for key, document in documents.items() if not is_journal_document_completed(document)
+        }
+        temporary_path = journal_path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as journal_file:
+            for key, document in documents.items():
+                if 'info' in document:
+                    document.pop('text', None)
+                journal_file.write(json.dumps(dict(document, key=key), ensure_ascii=False) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temporary_path, journal_path)
+
+    return {
+        'file': open(journal_path, 'a', encoding='utf-8'),
+        'documents': documents,
+        'lock': threading.Lock(),
+        'unsynced': 0
+    }
+
+# Funzione per registrare nel journal il completamento di una fase di un documento
+# Ogni record viene scritto subito (sopravvive a un crash del processo) e l'fsync su disco avviene a blocchi
+def journal_record(journal, key, file_name, stage, **data):
+    if journal is None:
+        return
+    with journal['lock']:
+        journal['file'].write(
+            json.dumps(dict(data, key=key, file=file_name, stage=stage), ensure_ascii=False) + '\n'
+        )
+        journal['file'].flush()
+        document = journal['documents'].setdefault(key, {'stages': []})
+        document['stages'].append(stage)
+        document.update(data, file=file_name)
+        journal['unsynced'] += 1
+        if journal['unsynced'] >= journal_fsync_every:
+            os.fsync(journal['file'].fileno())
+            journal['unsynced'] = 0
+
+# Funzione per sapere se una fase di un documento è già stata completata
+def journal_stage_done(journal, key, stage):
+    return journal is not None and stage in journal['documents'].get(key, {}).get('stages', [])
+
+# Funzione per forzare la scrittura su disco dei record del journal (prima di un'operazione non ripetibile,
+# come lo spostamento del PDF: dopo un crash il journal deve sapere che il documento era già estratto)
+def sync_journal(journal):
+    with journal['lock']:
+        journal['file'].flush()
+        os.fsync(journal['file'].fileno())
+        journal['unsynced'] = 0
+
+# Funzione per chiudere il journal forzando la scrittura su disco dei record rimasti
+def close_journal(journal):
+    sync_journal(journal)
+    journal['file'].close()
+
+# Funzione per leggere i documenti omessi per il limite di memoria nelle esecuzioni precedenti
+def load_skipped_documents(skipped_path):
+    if not os.path.isfile(skipped_path):
+        return {}
+    with open(skipped_path, encoding='utf-8') as file:
+        return json.load(file)
+
+# Funzione per salvare i documenti omessi in modo atomico (file temporaneo + rinomina)
+def save_skipped_documents(skipped_documents, skipped_path):
+    temporary_path = skipped_path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump(skipped_documents, file, ensure_ascii=False, indent=2)
+    os.replace(temporary_path, skipped_path)
+
+# Funzione per descrivere un documento omesso: se cambiano il file o il tetto di memoria viene elaborato di nuovo
+def get_skip_fingerprint(pdf_path):
+    stat = os.stat(pdf_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'max_worker_memory_mb': max_worker_memory_mb}
+
+# Funzione per leggere le righe già scritte nel CSV (senza l'intestazione)
+# In ripresa una riga identica non viene riscritta: copre un crash tra la scrittura e il suo record nel journal
+def read_csv_rows(csv_file):
+    if not os.path.isfile(csv_file):
+        return set()
+    with open(csv_file, newline='', encoding='utf-8') as file:
+        rows = list(csv.reader(file, delimiter=';'))
+    return {tuple(row) for row in rows[1:] if row}
+
+# Righe OCR lette in modalità ROI per ogni PDF, in attesa dei dati estratti per aggiornare i profili
+roi_lines_by_file = {}
+
+# Marcatore di fine flusso che attraversa le code della pipeline
+PIPELINE_DONE = object()
+
+# Testo con cui si confrontano gli embeddings dei segmenti per misurarne la rilevanza
+SEGMENT_RELEVANCE_QUERY = (
+    "Factura: número de factura, fecha de factura, empresa de servicio, CIF/NIF, cliente, "
+    "base imponible, IVA %, IVA total, total a pagar"
+)
+
+# Funzione per ottenere l'embedding di un testo dall'endpoint embeddings di Ollama
+def get_embedding(text, api_url):
+    embeddings_url = api_url.rsplit('/api/', 1)[0] + '/api/embeddings'
+    with factalia_common.ollama_slots:
+        response = get_ollama_session().post(
+            embeddings_url, json={"model": segment_embedding_model, "prompt": text}
+        )
+    response.raise_for_status()
+    return np.asarray(response.json()['embedding'], dtype=np.float32)
+
+# Funzione per calcolare la rilevanza di ogni segmento: parole chiave, importi e CIF/NIF ('keywords')
+# oppure similarità coseno con SEGMENT_RELEVANCE_QUERY ('embeddings', con ripiego sulle parole chiave)
+def score_segments(segments, api_url):
+    if segment_relevance == 'embeddings':
+        try:
+            with ThreadPoolExecutor(max_workers=factalia_common.ollama_num_parallel) as executor:
+                query, *vectors = executor.map(
+                    lambda text: get_embedding(text, api_url), [SEGMENT_RELEVANCE_QUERY] + segments
+                )
+            return [
+                float(vector @ query / (np.linalg.norm(vector) * np.linalg.norm(query) or 1.0))
+                for vector in vectors
+            ]
+        except (requests.RequestException, KeyError, ValueError) as e:
+            print(f"Embeddings no disponibles, se usan las palabras clave: {e}")
+    return [score_page_fields(segment) for segment in segments]
+
+# Funzione per tenere solo i max_formatted_segments segmenti più rilevanti, nel loro ordine originale
+# (i segmenti con rilevanza nulla vengono scartati, a meno che nessun segmento ne abbia)
+def select_segments(segments, api_url):
+    if max_formatted_segments is None or len(segments) <= max_formatted_segments:
+        return segments
+    scores = score_segments(segments, api_url)
+    ranked = sorted(range(len(segments)), key=lambda index: (-scores[index], index))
+    relevant = [index for index in ranked if scores[index] > 0] or ranked
+    selected = sorted(relevant[:max_formatted_segments])
+    print(f"Segmentos seleccionados: {[index + 1 for index in selected]} de {len(segments)}")
+    return [segments[index] for index in selected]
+
+# Funzione per costruire il prompt di formattazione di un segmento di testo (formatting_prompt dello script)
+def build_formatting_prompt(segment):
+    return formatting_prompt.format(segment=segment)
+
+# Funzione per formattare un segmento di testo con LLaMA
+def format_segment(segment, api_key, api_url):
+    return query_llama_3(api_key, api_url, build_formatting_prompt(segment))
+
+# Funzione per formattare il testo estratto con LLaMA: solo i segmenti più rilevanti, formattati in parallelo
+# (le richieste effettive verso Ollama restano limitate da ollama_slots)
+# Ogni segmento occupa quanto resta di prompt_token_budget dopo le istruzioni del prompt di formattazione
+def format_text(extracted_text, api_key, api_url):
+    segment_tokens = prompt_token_budget - estimate_tokens(build_formatting_prompt(''))
+    segmented_text = select_segments(split_text(extracted_text, segment_tokens), api_url)
+    if len(segmented_text) > 1:
+        with ThreadPoolExecutor(max_workers=len(segmented_text)) as executor:
+            formatted_texts = list(executor.map(
+                lambda segment: format_segment(segment, api_key, api_url), segmented_text
+            ))
+    else:
+        formatted_texts = [format_segment(segment, api_key, api_url) for segment in segmented_text]
+
+    return "\n\n".join(formatted_text for formatted_text in formatted_texts if formatted_text)
+
+# Fase "testo" della pipeline: text layer o rasterizzazione + OCR, ripresi dal journal se già presenti
+# Con memory_limit_policy = 'skip_document' un documento oltre il tetto di memoria viene omesso:
+# la fase 'skipped' è finale, il documento non passa al LLM e non viene rielaborato in ripresa
+def text_stage(item, ocr_pool=None, journal=None):
+    document = journal['documents'].get(item['key'], {}) if journal else {}
+    if 'info' in document:
+        print(f"\n{item['file_name']}: dati già estratti nel journal")
+        item.update(info=document['info'], page_methods=document['page_methods'])
+    elif journal_stage_done(journal, item['key'], 'skipped'):
+        print(f"\n{item['file_name']}: omesso per il limite di memoria (journal)")
+        item.update(skipped=document['reason'], page_methods=[])
+    elif 'text' in document:
+        item.update(text=document['text'], page_methods=document['page_methods'])
+    else:
+        print(f"\nElaborando: {item['pdf_path']}")
+        try:
+            item['text'], item['page_methods'] = extract_text_from_pdf(
+                item['pdf_path'], ocr_pool, item['file_hash']
+            )
+        except PageMemoryLimitExceeded as e:
+            print(f"Documento {item['file_name']} omitido por límite de memoria: {e}")
+            journal_record(journal, item['key'], item['file_name'], 'skipped', reason=str(e))
+            item.update(skipped=str(e), page_methods=[])
+            return item
+        journal_record(
+            journal, item['key'], item['file_name'], 'ocr', text=item['text'], page_methods=item['page_methods']
+        )
+    return item
+
+# Fase "formattazione" della pipeline: riordino del testo in sezioni con LLaMA
+def format_stage(item, api_key, api_url):
+    if 'info' not in item and 'skipped' not in item:
+        item['formatted_text'] = format_text(item['text'], api_key, api_url)
+    return item
+
+# Fase "estrazione" della pipeline: estrazione dei campi in JSON con LLaMA
+def extract_stage(item, api_key, api_url, journal=None):
+    if 'info' not in item and 'skipped' not in item:
+        item['info'] = extract_info_from_text(item['formatted_text'], api_key, api_url, item['file_name'])
+        journal_record(journal, item['key'], item['file_name'], 'llm', info=item['info'])
+        learn_roi_profile(roi_lines_by_file.pop(item['pdf_path'], []), item['info'])
+    return item
+
+# Funzione per avviare una fase della pipeline: `workers` thread leggono da input_queue e scrivono su output_queue
+# Le code sono limitate, quindi una fase veloce si ferma (backpressure) quando la successiva è in ritardo
+def start_pipeline_stage(stage_function, input_queue, output_queue, workers):
+    def worker():
+        while True:
+            item = input_queue.get()
+            if item is PIPELINE_DONE:
+                input_queue.put(PIPELINE_DONE)  # Lo rimette in coda per gli altri worker della fase
+                return
+            try:
+                output_queue.put(stage_function(item))
+            except Exception as e:
+                print(f"Error elaborando {item['file_name']}: {e}")
+
+    # Quando tutti i worker hanno finito, la fine del flusso passa alla fase successiva
+    def close_stage():
+        for thread in threads:
+            thread.join()
+        output_queue.put(PIPELINE_DONE)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    threading.Thread(target=close_stage, daemon=True).start()
+
+# Funzione per elaborare più PDF in pipeline (testo → formattazione → estrazione → scrittura)
+# Mentre LLaMA lavora su un documento, l'OCR prepara già i successivi: il tempo totale tende alla fase più lenta
+# items sono dizionari con 'pdf_path', 'file_name', 'file_hash' e 'key' (chiave nel journal).
+# Restituisce (item, extracted_info, page_methods) man mano che i documenti vengono completati
+# (extracted_info è None per i documenti omessi per il limite di memoria)
+def process_pdfs_concurrently(items, api_key, api_url, ocr_pool=None, journal=None):
+    path_queue = queue.Queue()
+    text_queue = queue.Queue(maxsize=pipeline_queue_size)
+    formatted_queue = queue.Queue(maxsize=pipeline_queue_size)
+    result_queue = queue.Queue(maxsize=pipeline_queue_size)
+
+    start_pipeline_stage(
+        lambda item: text_stage(item, ocr_pool, journal), path_queue, text_queue, pipeline_text_workers
+    )
+    start_pipeline_stage(
+        lambda item: format_stage(item, api_key, api_url), text_queue, formatted_queue,
+        pipeline_format_workers or factalia_common.ollama_num_parallel
+    )
+    start_pipeline_stage(
+        lambda item: extract_stage(item, api_key, api_url, journal), formatted_queue, result_queue,
+        pipeline_extract_workers or factalia_common.ollama_num_parallel
+    )
+
+    for item in items:
+        path_queue.put(dict(item))
+    path_queue.put(PIPELINE_DONE)
+
+    while True:
+        item = result_queue.get()
+        if item is PIPELINE_DONE:
+            break
+        yield item, item.get('info'), item['page_methods']
+
+# Funzione principale per elaborare tutti i file PDF in una cartella
+# Il batch è registrato in un journal: dopo un crash l'esecuzione successiva riprende da dove si era fermata
+def process_pdf_folder(folder_path, api_key, api_url, csv_file, output_folder):
+    journal_path = csv_file + '.journal'
+    resuming = os.path.isfile(journal_path)
+    journal = open_journal(journal_path)
+    skipped_path = csv_file + '.skipped.json'
+    skipped_documents = load_skipped_documents(skipped_path)
+    written_rows = read_csv_rows(csv_file) if resuming else set()
+    write_header = not resuming or not os.path.isfile(csv_file)
+    if resuming:
+        print(f"Ripresa del batch interrotto ({len(journal['documents'])} documenti nel journal)")
+
+    csv_mode = 'a' if resuming else 'w'  # In ripresa il CSV esistente non viene troncato
+    # Con ocr_workers = 0 non si avvia il pool: l'OCR avviene nel processo principale (ocr_pool è None)
+    ocr_pool_context = nullcontext() if ocr_workers == 0 else create_ocr_pool()
+    with ocr_pool_context as ocr_pool, open(csv_file, csv_mode, newline='', encoding='utf-8') as file:
+        csv_writer = csv.writer(file, delimiter=';')  # Imposta il separatore a ";"
+        if write_header:
+            link_header = ['Link al file rinominato'] if csv_link_column else []
+            csv_writer.writerow(['Nombre del archivo PDF'] + link_header + invoice_fields)
+        
+        pdf_paths = [
+            os.path.join(folder_path, file_name)
+            for file_name in os.listdir(folder_path)
+            if file_name.lower().endswith('.pdf')
+        ]
+        # I PDF omessi per il limite di memoria restano nella cartella: si riprovano solo se cambiano
+        # il file o max_worker_memory_mb
+        unchanged_skipped = [
+            pdf_path for pdf_path in pdf_paths
+            if os.path.basename(pdf_path) in skipped_documents
+            and skipped_documents[os.path.basename(pdf_path)]['fingerprint'] == get_skip_fingerprint(pdf_path)
+        ]
+        if unchanged_skipped:
+            print(f"{len(unchanged_skipped)} documentos omitidos por límite de memoria en ejecuciones anteriores")
+        items = []
+        for pdf_path in pdf_paths:
+            if pdf_path not in unchanged_skipped:
+                file_hash = file_sha256(pdf_path)
+                file_name = os.path.basename(pdf_path)
+                items.append({
+                    'pdf_path': pdf_path, 'file_name': file_name, 'file_hash': file_hash,
+                    'key': get_journal_key(file_hash, file_name)
+                })
+        # Documenti già estratti ma non ancora scritti o spostati (il PDF potrebbe non essere più nella cartella).
+        # Se nella cartella c'è un altro PDF con lo stesso nome, l'originale è stato sostituito: si riprende
+        # solo se era già stato spostato (manca la riga nel CSV)
+        input_keys = {item['key'] for item in items}
+        input_names = {item['file_name'] for item in items}
+        items += [
+            {
+                'pdf_path': os.path.join(folder_path, document['file']), 'file_name': document['file'],
+                'file_hash': key.split(':', 1)[0], 'key': key
+            }
+            for key, document in journal['documents'].items()
+            if 'info' in document and not is_journal_document_completed(document) and key not in input_keys
+            and ('moved' in document['stages'] or document['file'] not in input_names)
+        ]
+        page_methods_total = []
+        completed = 0
+
+        for item, extracted_info, page_methods in process_pdfs_concurrently(
+            items, api_key, api_url, ocr_pool, journal=journal
+        ):
+            pdf_path, file_name, key = item['pdf_path'], item['file_name'], item['key']
+            page_methods_total.extend(page_methods)
+            
+            if extracted_info is None:
+                # Documento omesso: resta nella cartella di input e conta come completato
+                skipped_documents[file_name] = {
+                    'fingerprint': get_skip_fingerprint(pdf_path),
+                    'reason': journal['documents'][key]['reason']
+                }
+                save_skipped_documents(skipped_documents, skipped_path)
+                completed += 1
+                continue
+            
+            # Un errore su un documento (ad es. lo spostamento) non ferma il batch: il journal resta per la ripresa
+            try:
+                if journal_stage_done(journal, key, 'moved'):
+                    new_file_path = journal['documents'][key]['new_file_path']
+                else:
+                    sync_journal(journal)
+                    new_file_path = rename_and_move_pdf(pdf_path, extracted_info, output_folder)
+                    journal_record(journal, key, file_name, 'moved', new_file_path=new_file_path)
+            
+                # Con csv_link_column la seconda colonna contiene il percorso completo del PDF rinominato
+                link = [f"file://{new_file_path}"] if csv_link_column else []
+                row = (
+                    [clean_text(extracted_info.get('Nombre del archivo PDF', 'No disponible'))] + link
+                    + [clean_text(extracted_info.get(field, 'No disponible')) for field in invoice_fields]
+                )
+                if not journal_stage_done(journal, key, 'row') and tuple(row) not in written_rows:
+                    csv_writer.writerow(row)
+                    file.flush()
+                    os.fsync(file.fileno())
+                    journal_record(journal, key, file_name, 'row')
+
+                print(f"Información extraída para {file_name} guardada en el CSV.")
+                completed += 1
+            except Exception as e:
+                print(f"Error guardando {file_name}: {e}")
+
+        if page_methods_total:
+            text_layer_pages = page_methods_total.count('text_layer')
+            print(
+                f"\nPáginas leídas del texto del PDF: {text_layer_pages}/{len(page_methods_total)} "
+                f"(OCR evitado en el {text_layer_pages / len(page_methods_total):.0%} de las páginas)"
+            )
+        print(f"Caché de texto: {text_cache_stats['hits']} aciertos, {text_cache_stats['misses']} fallos, "
+              f"{text_cache_stats['evictions']} entradas eliminadas")
+        print(f"Tokens: {token_stats['calls']} llamadas, {token_stats['prompt_tokens']} de entrada, "
+              f"{token_stats['completion_tokens']} de salida")
+
+    close_journal(journal)
+    if completed == len(items):
+        os.remove(journal_path)  # Batch completato: il prossimo avvio parte da zero
+    else:
+        print(f"{len(items) - completed} documenti non completati: il journal resta per la ripresa")
+
+# Campi estratti da ogni fattura (stesso ordine delle colonne del CSV), campo del CIF/NIF del fornitore
+# e campo con il nome del fornitore (usato nel nome del PDF rinominato): li definisce ogni script
+invoice_fields = []
+cif_field = None
+company_field = None
+
+# Prompt di formattazione dei segmenti di testo, con il segnaposto {segment} (lo definisce ogni script)
+formatting_prompt = "{segment}"
+
+# Aggiunge al CSV, come seconda colonna, il link al PDF rinominato
+csv_link_column = False
+
+# Numero di worker OCR (None = uno per ogni core disponibile, 0 = nessun pool: OCR nel processo principale,
+# senza copiare le pagine verso i worker) e thread CPU usati da ciascun worker
+ocr_workers = None
+ocr_cpu_threads = 1
+
+# Modalità a memoria limitata: tetto di RSS per worker OCR in MB (None = nessun limite),
+# memoria stimata per l'OCR in multipli dei byte dell'immagine e cosa fare se il tetto verrebbe superato
+max_worker_memory_mb = None
+ocr_memory_factor = 8
+memory_limit_policy = 'skip_page'  # 'skip_page' (pagina senza testo) o 'skip_document' (documento omesso)
+
+# Preprocessing delle pagine prima dell'OCR (eseguito nei worker): passi da applicare, in ordine,
+# altezza del testo da mantenere nella riduzione, inclinazione massima cercata e parametri del ritaglio
+use_preprocessing = False
+preprocessing_steps = ('grayscale', 'downscale', 'binarize', 'deskew', 'crop')
+target_text_height = 24  # Pixel
+max_deskew_angle = 5  # Gradi
+deskew_angle_step = 0.25
+deskew_max_points = 20000  # Pixel scuri campionati per stimare l'inclinazione
+max_border_ink = 0.8  # Righe/colonne più scure di così sono bande di scansione, non contenuto
+crop_margin = 10  # Pixel
+
+# Riciclo dei worker OCR: il pool viene sostituito (con i nuovi worker già caricati) quando un worker
+# ha elaborato pagine di worker_recycle_documents documenti o supera worker_recycle_rss_mb di RSS (None = mai)
+worker_recycle_documents = 200
+worker_recycle_rss_mb = None
+
+# Pipeline: thread per fase (None = ollama_num_parallel per le fasi LLM) e capienza delle code tra le fasi
+pipeline_text_workers = 2
+pipeline_format_workers = None
+pipeline_extract_workers = None
+pipeline_queue_size = 4
+
+# Formattazione dei segmenti di testo: vengono formattati (in parallelo) solo i max_formatted_segments
+# segmenti più rilevanti (None = tutti); rilevanza per parole chiave ('keywords') o con gli embeddings
+# di Ollama ('embeddings', modello segment_embedding_model da scaricare con "ollama pull")
+max_formatted_segments = 3
+segment_relevance = 'keywords'
+segment_embedding_model = 'nomic-embed-text'
+
+# Ogni quanti record del journal si forza la scrittura su disco (fsync)
+journal_fsync_every = 20
+
+# Finestra di contesto (num_ctx) e token massimi dei prompt (istruzioni + testo):
+# prompt_token_budget per la formattazione di ogni segmento, extraction_token_budget per l'estrazione;
+# il testo viene diviso o ridotto a fine riga per rientrare nel budget
+llm_num_ctx = 4096
+prompt_token_budget = 1000
+extraction_token_budget = 3000
+
+# Token massimi generati per la risposta JSON dell'estrazione e lettura in streaming con interruzione anticipata
+extraction_num_predict = 300
+use_streaming = True
+
+# Rasterizzazione delle pagine da passare all'OCR: 'pymupdf' (nel processo) o 'pdf2image' (pdftoppm)
+render_backend = 'pymupdf'
+render_dpi = 200  # Stessa risoluzione predefinita di pdf2image
+render_grayscale = False  # In scala di grigi le immagini occupano un terzo della memoria
+
+# Soglie per accettare il livello di testo del PDF senza OCR
+min_text_layer_chars = 200  # Caratteri minimi (senza spazi) per pagina
+max_text_layer_garbage = 0.1  # Percentuale massima di caratteri spazzatura
+TEXT_LAYER_SYMBOLS = set(".,;:%€$/-()+*#ºª°@&'\"_=<>[]|")
+
+# Selezione delle pagine: al massimo page_budget pagine per documento, scelte per punteggio (parole chiave,
+# importi, CIF/NIF) tra le prime page_scan_limit pagine più l'ultima; le pagine senza livello di testo
+# vengono valutate con l'OCR di una miniatura a page_thumbnail_dpi (None = solo in base alla posizione)
+page_budget = 2
+page_scan_limit = 20
+page_thumbnail_dpi = 72
+
+# Il modello (llm_model), la cache del testo (text_cache_path, text_cache_max_bytes, text_cache_enabled) e le
+# richieste contemporanee verso Ollama (ollama_num_parallel) sono impostazioni di factalia_common: configure le inoltra
+
+# OCR a lotti: detection per pagina nei worker, riconoscimento dei ritagli di riga di più pagine e documenti
+# in lotti da ocr_rec_batch_size ritagli (attendendo al massimo ocr_batch_wait secondi per riempire un lotto);
+# ocr_rec_batch_num è la dimensione dei gruppi che il recognizer di PaddleOCR elabora insieme
+use_batched_ocr = False
+ocr_rec_batch_size = 64
+ocr_batch_wait = 0.05
+ocr_rec_batch_num = 16
+
+# OCR per regioni (ROI): detection su tutta la pagina e riconoscimento solo delle righe utili.
+# Fasce predefinite (intestazione e totali, in frazioni dell'altezza), distanza dalle parole chiave,
+# margine delle fasce apprese e file in cui vengono salvati i profili per fornitore
+use_roi_ocr = False
+roi_default_bands = [(0.0, 0.3), (0.65, 1.0)]
+roi_anchor_distance = 0.03
+roi_band_margin = 0.01
+roi_profiles_path = 'roi_profiles.json'  # Gli script lo mettono accanto al CSV
+
+# Impostazioni passate a configure, ripetute nei worker OCR
+configured_settings = {}
+
+# Funzione per cambiare le impostazioni della pipeline (campi, prompt, modello, percorsi, parametri di OCR e LLM)
+# Accetta solo i nomi delle variabili del modulo e le impostazioni di factalia_common (modello, cache di testo,
+# richieste parallele a Ollama), che vengono inoltrate: un nome sbagliato solleva ValueError
+def configure(**settings):
+    unknown = [
+        name for name in settings if name not in factalia_common.SETTINGS
+        and (name not in globals() or name.isupper() or callable(globals()[name]))
+    ]
+    if unknown:
+        raise ValueError(f"Impostazioni sconosciute: {unknown}")
+    factalia_common.configure(**{name: value for name, value in settings.items() if name in factalia_common.SETTINGS})
+    globals().update({name: value for name, value in settings.items() if name not in factalia_common.SETTINGS})
+    configured_settings.update(settings)
@@ -0,0 +1,121 @@
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+# ocr_pipeline importa PaddleOCR, OpenCV e le librerie PDF all'avvio: senza di esse la prova viene saltata
+for module in ('cv2', 'requests', 'pdfplumber', 'paddleocr', 'pdf2image', 'fitz'):
+    pytest.importorskip(module)
+
+import ocr_pipeline
+
+# Finto motore PaddleOCR: come resize_norm_img, classifier e recognizer rifiutano immagini senza 3 canali
+class FakeOcrEngine:
+    use_angle_cls = True
+
+    def __init__(self):
+        self.recognized = []
+
+    def text_classifier(self, crops):
+        for crop in crops:
+            assert crop.ndim == 3 and crop.shape[2] == 3
+        return crops, None, 0
+
+    def text_recognizer(self, crops):
+        for crop in crops:
+            assert crop.ndim == 3 and crop.shape[2] == 3
+        self.recognized.extend(crops)
+        return [(f"riga {index}", 0.99) for index in range(len(crops))], 0
+
+
+# Pagina in scala di grigi (render_grayscale): due righe di "testo" scuro su sfondo bianco
+def make_grayscale_page():
+    page = np.full((120, 300), 255, dtype=np.uint8)
+    page[20:40, 10:200] = 0
+    page[70:90, 10:250] = 0
+    return page
+
+
+def test_recognize_crops_accepts_grayscale_page(monkeypatch):
+    engine = FakeOcrEngine()
+    monkeypatch.setattr(ocr_pipeline, 'ocr_engine', engine)
+
+    page = make_grayscale_page()
+    crops = ocr_pipeline.crop_lines(page, [(10, 20, 200, 40), (10, 70, 250, 90)])
+
+    assert [crop.ndim for crop in crops] == [2, 2]  # I ritagli inviati ai worker restano a un canale
+    assert ocr_pipeline.recognize_crops(crops) == ['riga 0', 'riga 1']
+    assert [crop.shape for crop in engine.recognized] == [(20, 190, 3), (20, 240, 3)]
+    assert (engine.recognized[0] == 0).all()
+
+
+# Pool OCR con thread al posto dei processi: il finto motore resta visibile ai task
+@pytest.fixture
+def batched_pool(monkeypatch):
+    monkeypatch.setattr(ocr_pipeline, 'ocr_engine', FakeOcrEngine())
+    monkeypatch.setattr(ocr_pipeline, 'use_batched_ocr', True)
+    monkeypatch.setattr(ocr_pipeline, 'ocr_batch_wait', 0.01)
+    monkeypatch.setattr(ocr_pipeline, 'create_ocr_executor', ThreadPoolExecutor)
+    return ocr_pipeline.create_ocr_pool
+
+
+def test_each_ocr_pool_has_its_own_rec_batcher(batched_pool):
+    crops = ocr_pipeline.crop_lines(make_grayscale_page(), [(10, 20, 200, 40)])
+    for _ in range(2):  # Il secondo pool non deve restare in attesa del thread dei lotti del primo
+        with batched_pool(max_workers=1) as ocr_pool:
+            assert ocr_pipeline.submit_crops(ocr_pool, crops).result(timeout=5) == ['riga 0']
+
+
+def test_rec_batcher_failure_is_set_on_pending_futures(batched_pool, monkeypatch):
+    def broken_submit(*args):
+        raise RuntimeError('pool rotto')
+
+    monkeypatch.setattr(ocr_pipeline, 'submit_ocr_task', broken_submit)
+    crops = ocr_pipeline.crop_lines(make_grayscale_page(), [(10, 20, 200, 40)])
+    with batched_pool(max_workers=1) as ocr_pool:
+        futures = [ocr_pipeline.submit_crops(ocr_pool, crops) for _ in range(3)]
+        for future in futures:
+            with pytest.raises(RuntimeError, match='pool rotto'):
+                future.result(timeout=5)
+        with pytest.raises(RuntimeError, match='pool rotto'):
+            ocr_pipeline.submit_crops(ocr_pool, crops).result(timeout=5)
+
+
+# Le pagine a colori arrivano a PaddleOCR in BGR come array contigui: nessuna vista da copiare di nuovo
+def test_to_ocr_layout_returns_contiguous_bgr():
+    rgb = np.zeros((4, 6, 3), dtype=np.uint8)
+    rgb[..., 0] = 255  # Rosso
+    rgb.flags.writeable = False  # Come la vista sul buffer del pixmap
+
+    bgr = ocr_pipeline.to_ocr_layout(rgb)
+
+    assert bgr.flags['C_CONTIGUOUS'] and bgr.flags['OWNDATA']
+    assert (bgr[..., 2] == 255).all() and (bgr[..., 0] == 0).all()
+    gray = np.zeros((4, 6), dtype=np.uint8)
+    assert ocr_pipeline.to_ocr_layout(gray) is gray
+
+
+# Il tetto di memoria solleva un errore proprio, che deve tornare intatto dai worker (pickle)
+def test_memory_limit_raises_page_memory_limit_exceeded(monkeypatch):
+    monkeypatch.setattr(ocr_pipeline, 'max_worker_memory_mb', 1)
+    with pytest.raises(ocr_pipeline.PageMemoryLimitExceeded) as error:
+        ocr_pipeline.check_worker_memory(make_grayscale_page())
+
+    assert isinstance(error.value, MemoryError)
+    assert isinstance(pickle.loads(pickle.dumps(error.value)), ocr_pipeline.PageMemoryLimitExceeded)
+
+
+# Annullando il Future di una pagina (documento omesso) il task in coda non viene eseguito dal worker
+def test_cancelled_ocr_task_does_not_run(monkeypatch):
+    monkeypatch.setattr(ocr_pipeline, 'use_batched_ocr', False)
+    monkeypatch.setattr(ocr_pipeline, 'create_ocr_executor', ThreadPoolExecutor)
+    release, ran = threading.Event(), []
+    with ocr_pipeline.create_ocr_pool(max_workers=1) as ocr_pool:
+        running = ocr_pipeline.submit_ocr_task(ocr_pool, 'a.pdf', release.wait, 5)
+        queued = ocr_pipeline.submit_ocr_task(ocr_pool, 'a.pdf', ran.append, 'pagina 2')
+        assert queued.cancel()
+        release.set()
+        assert running.result(timeout=5) is True
+    assert ran == []
@@ -1,85 +1,324 @@
 import os
 import io
+import re
 import csv
+import math
+import textwrap
+import threading
 import pdfplumber
 import openai
+try:
+    import tiktoken  # Conteggio esatto dei token dei modelli OpenAI (facoltativo)
+except ImportError:
+    tiktoken = None
+from google.auth.credentials import AnonymousCredentials
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 # Configura le credenziali di Google Drive
 SCOPES = ['https://www.googleapis.com/auth/drive']
 SERVICE_ACCOUNT_FILE = 'credentials.json'  # Sostituisci con il percorso del tuo file di credenziali
 
-creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-drive_service = build('drive', 'v3', credentials=creds)
+# Endpoint alternativo dell'API di Drive (ad es. un finto Drive locale per le prove); None = Google
+DRIVE_API_ENDPOINT = os.environ.get('DRIVE_API_ENDPOINT')
+
+# Download concorrenti: thread di download e PDF al massimo in memoria (scaricati o in download)
+# fino alla fine della loro estrazione; file per pagina nell'elenco della cartella
+DOWNLOAD_WORKERS = 8
+MAX_PENDING_DOWNLOADS = 16
+LIST_PAGE_SIZE = 1000
+
+# Client di Drive per thread: il trasporto HTTP del client non è thread-safe
+drive_local = threading.local()
 
 # Configura OpenAI API
 openai.api_key = 'YOU_OPENAI_API_KEY'  
 
-# Funzione per scaricare un PDF da Google Drive
-def download_pdf(file_id, destination):
-    request = drive_service.files().get_media(fileId=file_id)
-    fh = io.FileIO(destination, 'wb')
-    downloader = MediaIoBaseDownload(fh, request)
+# Modello, finestra di contesto e token riservati alla risposta: prompt e testo della fattura
+# vengono ridotti per rientrare in MAX_CONTEXT_TOKENS - MAX_RESPONSE_TOKENS
+MODEL = "gpt-3.5-turbo"
+MAX_CONTEXT_TOKENS = 4096
+MAX_RESPONSE_TOKENS = 500
+CHARS_PER_TOKEN = 3.6  # Stima usata senza tiktoken (fatture in spagnolo)
+SYSTEM_MESSAGE = "You are a helpful assistant that extracts key information from invoices."
+
+# Valori con cui il modello indica che non ha trovato un dato
+EMPTY_VALUES = {'', 'valor', 'n/a', 'none', 'null', 'no disponible', 'no especificado', 'no especificada', 'no encontrado'}
+
+# Campi con importi: unendo le pagine si tiene il valore dell'ultima pagina (i totali finali della fattura)
+AMOUNT_FIELDS = {'IVA', 'BASE TOTAL', 'IVA TOTAL', 'TOTAL'}
+
+# Token di input e di output delle chiamate a OpenAI
+token_stats = {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+
+# Selezione delle pagine: al massimo PAGE_BUDGET pagine per fattura, scelte per punteggio
+# tra le prime PAGE_SCAN_LIMIT pagine (più l'ultima)
+PAGE_BUDGET = 2
+PAGE_SCAN_LIMIT = 20
+
+# Parole chiave che indicano una pagina con i dati della fattura, con il loro peso nel punteggio
+PAGE_KEYWORDS = {
+    r'factura': 3,
+    r'fecha': 1,
+    r'cliente|titular': 1,
+    r'\bc\.?i\.?f\b|\bn\.?i\.?f\b': 2,
+    r'base\s+imponible|imponible': 3,
+    r'\biva\b': 2,
+    r'\btotal\b': 3,
+    r'importe|subtotal': 1
+}
+AMOUNT_PATTERN = re.compile(r'\d+[.,]\d{2}(?!\d)')
+TAX_ID_PATTERN = re.compile(r'[A-HJ-NP-SUVW]\d{7}[0-9A-J]|\d{8}[A-Z]|[XYZ]\d{7}[A-Z]')
+
+# Funzione per creare un client di Google Drive con le credenziali del service account
+# Con DRIVE_API_ENDPOINT si usano credenziali anonime: il service account chiederebbe un token a Google
+def build_drive_service():
+    if DRIVE_API_ENDPOINT:
+        creds = AnonymousCredentials()
+        client_options = {'api_endpoint': DRIVE_API_ENDPOINT}
+    else:
+        creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+        client_options = None
+    return build('drive', 'v3', credentials=creds, client_options=client_options, cache_discovery=False)
+
+# Funzione per ottenere il client di Drive del thread corrente, creato con service_factory
+# (per le prove si può passare una factory che restituisce un finto servizio con la stessa interfaccia)
+def get_drive_service(service_factory=build_drive_service):
+    services = drive_local.__dict__.setdefault('services', {})
+    if service_factory not in services:
+        services[service_factory] = service_factory()
+    return services[service_factory]
+
+# Funzione per elencare tutti i PDF di una cartella di Google Drive, seguendo nextPageToken
+def list_drive_pdfs(folder_id, service_factory=build_drive_service):
+    files = []
+    page_token = None
+    while True:
+        results = get_drive_service(service_factory).files().list(
+            q=f"'{folder_id}' in parents and mimeType='application/pdf' and trashed=false",
+            fields="nextPageToken, files(id, name)",
+            pageSize=LIST_PAGE_SIZE,
+            pageToken=page_token
+        ).execute()
+        files.extend(results.get('files', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return files
+
+# Funzione per scaricare un PDF da Google Drive in memoria (senza file temporanei)
+def download_pdf(file_id, service_factory=build_drive_service):
+    request = get_drive_service(service_factory).files().get_media(fileId=file_id)
+    buffer = io.BytesIO()
+    downloader = MediaIoBaseDownload(buffer, request)
     done = False
     while not done:
         status, done = downloader.next_chunk()
-        print(f"Download {int(status.progress() * 100)}%.")
+    buffer.seek(0)
+    return buffer
+
+# Funzione per scaricare i PDF in parallelo mentre quelli già scaricati vengono elaborati
+# Restituisce (file, future del download, release) man mano che i download terminano.
+# Ogni download occupa uno dei MAX_PENDING_DOWNLOADS posti dal momento in cui viene avviato finché
+# chi elabora il PDF non chiama release (dopo l'estrazione): così i PDF in memoria, scaricati o in download,
+# non superano mai MAX_PENDING_DOWNLOADS. release va chiamata prima di chiedere il file successivo
+# (download_file riceve l'ID del file e service_factory e restituisce il PDF in memoria)
+def download_pdfs(items, service_factory=build_drive_service, download_file=download_pdf):
+    items = iter(items)
+    download_slots = threading.Semaphore(MAX_PENDING_DOWNLOADS)
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        pending = {}
+
+        # Avvia un download per ogni posto libero (se non ne resta nessuno in corso aspetta un posto)
+        def submit_downloads():
+            while download_slots.acquire(blocking=not pending):
+                item = next(items, None)
+                if item is None:
+                    download_slots.release()
+                    return
+                pending[executor.submit(download_file, item['id'], service_factory)] = item
+
+        submit_downloads()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                yield item, future, download_slots.release
+                submit_downloads()
+
+# Funzione per contare i token di un testo (esatti con tiktoken, altrimenti stimati)
+def count_tokens(text):
+    if tiktoken is not None:
+        return len(tiktoken.encoding_for_model(MODEL).encode(text))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+# Funzione per ridurre un testo a un budget di token senza spezzare le righe: se non entra per intero
+# si tengono le prime righe e le ultime (dove di solito ci sono i totali)
+def fit_text_to_tokens(text, max_tokens, head_share=0.6):
+    if count_tokens(text) <= max_tokens:
+        return text
+    lines = [
+        piece for line in text.splitlines()
+        for piece in (textwrap.wrap(line, 200) if len(line) > 200 else [line])
+    ]
+    line_tokens = [count_tokens(line) + 1 for line in lines]
+
+    head, used_tokens = [], 0
+    for line, tokens in zip(lines, line_tokens):
+        if used_tokens + tokens > max_tokens * head_share:
+            break
+        head.append(line)
+        used_tokens += tokens
+
+    tail = []
+    for line, tokens in reversed(list(zip(lines, line_tokens))[len(head):]):
+        if used_tokens + tokens > max_tokens - 3:  # Spazio per il segnaposto "[...]"
+            break
+        tail.insert(0, line)
+        used_tokens += tokens
+    return '\n'.join(head + ['[...]'] + tail)
+
+# Funzione per registrare e mostrare i token di una risposta di OpenAI
+def record_token_usage(response):
+    usage = response.get('usage', {})
+    token_stats['calls'] += 1
+    token_stats['prompt_tokens'] += usage.get('prompt_tokens', 0)
+    token_stats['completion_tokens'] += usage.get('completion_tokens', 0)
+    print(f"Tokens: {usage.get('prompt_tokens', 0)} in, {usage.get('completion_tokens', 0)} out")
+
+# Funzione per stimare quanto è probabile che una pagina contenga i dati richiesti (parole chiave, importi, CIF/NIF)
+def score_page(text):
+    score = sum(weight for pattern, weight in PAGE_KEYWORDS.items() if re.search(pattern, text, re.IGNORECASE))
+    score += 0.5 * min(len(AMOUNT_PATTERN.findall(text)), 10)
+    score += 2 * min(len(set(TAX_ID_PATTERN.findall(re.sub(r'[\s.\-]', '', text.upper())))), 2)
+    return score
+
+# Funzione per scegliere le pagine da inviare al modello: legge il testo delle pagine candidate e tiene
+# le PAGE_BUDGET con il punteggio più alto (a parità, la prima e l'ultima), in ordine di documento
+def select_pages(pdf):
+    candidates = pdf.pages
+    if len(candidates) > PAGE_SCAN_LIMIT:
+        candidates = candidates[:PAGE_SCAN_LIMIT - 1] + candidates[-1:]
+
+    texts = {}
+    for page in candidates:
+        texts[page.page_number] = page.extract_text()
+        page.flush_cache()
+    if len(texts) <= PAGE_BUDGET:
+        return list(texts.items())
+
+    scores = {number: score_page(text or "") for number, text in texts.items()}
+    edges = (candidates[0].page_number, candidates[-1].page_number)
+    ranked = sorted(scores, key=lambda number: (-scores[number], number not in edges, number))
+    selected = sorted(ranked[:PAGE_BUDGET])
+    print(f"Selected pages: {selected} of {len(texts)} (scores: {[scores[number] for number in selected]})")
+    return [(number, texts[number]) for number in selected]
+
+# Funzione per inviare un messaggio a OpenAI; restituisce il testo della risposta o None in caso di errore
+def ask_openai(message_content):
+    try:
+        response = openai.ChatCompletion.create(
+            model=MODEL,
+            messages=[
+                {"role": "system", "content": SYSTEM_MESSAGE},
+                {"role": "user", "content": message_content}
+            ],
+            max_tokens=MAX_RESPONSE_TOKENS
+        )
+    except openai.error.InvalidRequestError as e:
+        print(f"Error extracting text: {e}")
+        return None
+    record_token_usage(response)
+    response_text = response['choices'][0]['message']['content']
+    print(f"OpenAI response: {response_text[:500]}")  # Mostra solo i primi 500 caratteri
+    return response_text
+
+# Funzione per calcolare i token disponibili per il testo della fattura con un certo prompt
+# (contesto meno risposta, messaggio di sistema, prompt e formato dei messaggi)
+def get_text_budget(request_prompt):
+    return MAX_CONTEXT_TOKENS - MAX_RESPONSE_TOKENS - count_tokens(SYSTEM_MESSAGE) - count_tokens(request_prompt) - 16
+
+# Funzione per ottenere i campi richiesti dal prompt (le righe "Campo: [valor]" del formato del risultato)
+def get_prompt_fields(prompt):
+    return re.findall(r'^(.+?):\s*\[valor\]\s*$', prompt, re.MULTILINE)
+
+# Funzione per verificare se il modello ha lasciato un campo senza valore
+def is_empty_value(value):
+    return value is None or value.strip().strip('[]').lower() in EMPTY_VALUES
+
+# Funzione per unire in modo deterministico i campi estratti dalle singole pagine (in ordine di documento):
+# gli importi si prendono dall'ultima pagina che li contiene (i totali finali), gli altri campi dalla prima
+# (i nomi dei campi nella risposta si confrontano senza distinguere maiuscole e minuscole;
+# se il prompt non elenca i campi si tengono tutti quelli presenti nelle risposte)
+def merge_page_results(page_results, fields):
+    fields = fields or list(dict.fromkeys(key for result in page_results for key in result))
+    page_results = [{key.casefold(): value for key, value in result.items()} for result in page_results]
+    data = {}
+    for field in fields:
+        key = field.casefold()
+        values = [result[key] for result in page_results if not is_empty_value(result.get(key))]
+        if values:
+            data[field] = values[-1] if field in AMOUNT_FIELDS else values[0]
+    return data
+
+# Funzione per costruire il prompt di richiesta dei soli campi mancanti
+def build_missing_fields_prompt(fields):
+    return (
+        "Extrae de la factura únicamente los siguientes datos clave:\n"
+        + "".join(f"- {field}\n" for field in fields)
+        + "Formato del resultado:\n"
+        + "".join(f"{field}: [valor]\n" for field in fields)
+    )
 
-# Funzione per estrarre il testo dalle prime due pagine di un PDF utilizzando GPT-3.5 Turbo
-def extract_text_from_pdf(pdf_path, prompt):
-    MAX_TOKENS = 4096  # Limite massimo di token per GPT-3.5-turbo per ogni richiesta
-    extracted_data = []
+# Funzione per estrarre i dati dalle pagine più rilevanti di un PDF utilizzando GPT-3.5 Turbo
+# pdf_file può essere un percorso o un file in memoria (BytesIO)
+# Il testo di ogni pagina viene inviato una sola volta: tutte le pagine in un'unica richiesta se rientrano
+# nel budget di token, altrimenti una richiesta per pagina con i risultati uniti in modo deterministico.
+# Per i campi ancora mancanti si fa al massimo una richiesta aggiuntiva che chiede solo quei campi.
+def extract_text_from_pdf(pdf_file, prompt):
+    fields = get_prompt_fields(prompt)
 
     try:
-        with pdfplumber.open(pdf_path) as pdf:
-            combined_extracted_text = ""
-
-            # Limita la lettura alle prime due pagine
-            total_pages = min(2, len(pdf.pages))
-
-            for page_number in range(total_pages):
-                page = pdf.pages[page_number]
-                text = page.extract_text()
-                if text:
-                    print(f"Text from page {page.page_number}: {text[:500]}")  # Mostra solo i primi 500 caratteri
-                    combined_extracted_text += text + "\n"
-
-                    # Prepara il messaggio per la richiesta
-                    message_content = prompt + "\n" + combined_extracted_text
-
-                    # Controlla se il messaggio supera il limite di token e tronca se necessario
-                    if len(message_content) > MAX_TOKENS:
-                        print(f"Warning: Content length exceeds the maximum token limit for GPT-3.5-turbo.")
-                        message_content = message_content[:MAX_TOKENS]  # Tronca il testo se necessario
-
-                    try:
-                        response = openai.ChatCompletion.create(
-                            model="gpt-3.5-turbo",
-                            messages=[
-                                {"role": "system", "content": "You are a helpful assistant that extracts key information from invoices."},
-                                {"role": "user", "content": message_content}
-                            ]
-                        )
-                        response_text = response['choices'][0]['message']['content']
-                        print(f"OpenAI response: {response_text[:500]}")  # Mostra solo i primi 500 caratteri
-                        
-                        # Unisce i dati estratti dalla risposta
-                        combined_extracted_text += response_text
-                    except openai.error.InvalidRequestError as e:
-                        print(f"Error extracting text: {e}")
-                        continue
-
-            # Analizza il testo combinato finale per estrarre i dati
-            data = parse_extracted_data(combined_extracted_text)
-            extracted_data.append(data)
+        with pdfplumber.open(pdf_file) as pdf:
+            # Limita la lettura alle pagine con il punteggio più alto (al massimo PAGE_BUDGET)
+            pages = [(page_number, text) for page_number, text in select_pages(pdf) if text]
+        for page_number, text in pages:
+            print(f"Text from page {page_number}: {text[:500]}")  # Mostra solo i primi 500 caratteri
+        page_texts = [text for page_number, text in pages]
+        document_text = "\n".join(page_texts)
+
+        # Tutto il documento in una richiesta se entra nel budget, altrimenti una richiesta per pagina
+        text_budget = get_text_budget(prompt)
+        if count_tokens(document_text) <= text_budget:
+            request_texts = [document_text] if document_text else []
+        else:
+            print(f"Document exceeds {text_budget} tokens for {MODEL}: one request per page.")
+            request_texts = [fit_text_to_tokens(page_text, text_budget) for page_text in page_texts]
+
+        page_results = []
+        for request_text in request_texts:
+            response_text = ask_openai(prompt + "\n" + request_text)
+            if response_text:
+                page_results.append(parse_extracted_data(response_text))
+        data = merge_page_results(page_results, fields)
+
+        # Una sola richiesta aggiuntiva con i soli campi mancanti
+        missing_fields = [field for field in fields if field not in data]
+        if missing_fields and document_text:
+            print(f"Missing fields: {missing_fields}")
+            missing_prompt = build_missing_fields_prompt(missing_fields)
+            response_text = ask_openai(
+                missing_prompt + "\n" + fit_text_to_tokens(document_text, get_text_budget(missing_prompt))
+            )
+            if response_text:
+                data.update(merge_page_results([parse_extracted_data(response_text)], missing_fields))
 
     except Exception as e:
         print(f"Error reading PDF: {e}")
         return []
-    
-    return extracted_data
+
+    return [data]
 
 # Funzione per parsare i dati direttamente dalla risposta di OpenAI
 def parse_extracted_data(response_text):
@@ -94,34 +333,40 @@ def parse_extracted_data(response_text):
     return data
 
 # Funzione per gestire il flusso di lavoro
-def process_invoices_from_drive(input_folder_id, output_folder_id, prompt):
-    results = drive_service.files().list(
-        q=f"'{input_folder_id}' in parents and mimeType='application/pdf'",
-        fields="files(id, name)"
-    ).execute()
-    items = results.get('files', [])
-
-    all_extracted_data = []
+# Elenca tutta la cartella, scarica i PDF in parallelo in memoria ed estrae i dati man mano che arrivano;
+# i risultati mantengono l'ordine dell'elenco della cartella.
+# list_files e download_file sostituiscono l'elenco e il download di Drive (ad es. nelle prove)
+def process_invoices_from_drive(input_folder_id, output_folder_id, prompt, service_factory=build_drive_service,
+                                list_files=list_drive_pdfs, download_file=download_pdf):
+    items = list_files(input_folder_id, service_factory)
 
     if not items:
         print('No files found.')
-    else:
-        for item in items:
-            file_id = item['id']
-            file_name = item['name']
-            print(f'Processing file: {file_name}')
-
-            pdf_path = f'/tmp/{file_name}'
-            download_pdf(file_id, pdf_path)
-
-            extracted_data = extract_text_from_pdf(pdf_path, prompt)
-            for data in extracted_data:
-                data["File"] = file_name
-
-            all_extracted_data.extend(extracted_data)
-            os.remove(pdf_path)
-
-    return all_extracted_data
+        return []
+    print(f'Found {len(items)} files.')
+
+    order = {item['id']: index for index, item in enumerate(items)}
+    results = []
+    for item, download, release_download in download_pdfs(items, service_factory, download_file):
+        file_name = item['name']
+        try:
+            pdf_file = download.result()
+        except Exception as e:
+            print(f"Error downloading {file_name}: {e}")
+            release_download()
+            continue
+        try:
+            print(f'Processing file: {file_name} ({pdf_file.getbuffer().nbytes // 1024} KB)')
+            extracted_data = extract_text_from_pdf(pdf_file, prompt)
+        finally:
+            pdf_file.close()  # Libera subito il buffer del PDF, prima di avviare il download successivo
+            release_download()
+        for data in extracted_data:
+            data["File"] = file_name
+        results.append((order[item['id']], extracted_data))
+
+    results.sort(key=lambda result: result[0])
+    return [data for index, extracted_data in results for data in extracted_data]
 
 # Funzione per salvare i risultati estratti in un file CSV
 def save_results_to_csv(results, csv_path):
@@ -146,6 +391,9 @@ def save_results_to_csv(results, csv_path):
         'TOTAL': 'TOTAL',
         'Nombre cliente': 'Nombre cliente',
         'NIF Cliente': 'NIF cliente',
+        'Nombre del cliente': 'Nombre cliente',
+        'NIF del cliente': 'NIF cliente',
+        'NIF de la compañía de servicio': 'NIF de la Compañía de servicio',
         'Compañía de servicio': 'Compañía de servicio',
         'NIF de la Compañía de servicio': 'NIF de la Compañía de servicio'
     }
@@ -164,14 +412,14 @@ def save_results_to_csv(results, csv_path):
             writer.writerow(standardized_result)
 
 # Funzione per caricare un file su Google Drive
-def upload_file_to_drive(file_path, folder_id):
+def upload_file_to_drive(file_path, folder_id, service_factory=build_drive_service):
     """Carica un file su Google Drive."""
     file_metadata = {
         'name': os.path.basename(file_path),
         'parents': [folder_id]
     }
     media = MediaFileUpload(file_path, mimetype='text/csv')
-    drive_service.files().create(body=file_metadata, media_body=media, fields='id').execute()
+    get_drive_service(service_factory).files().create(body=file_metadata, media_body=media, fields='id').execute()
 
 def main():
     input_folder_id = '18MmwjM_mYcKCEKa2JBIhDmlfNWbOO7YX'  # Inserisci l'ID della cartella Google Drive da cui leggere i PDF
@@ -207,6 +455,8 @@ def main():
     extracted_data = process_invoices_from_drive(input_folder_id, output_folder_id, prompt)
     save_results_to_csv(extracted_data, csv_path)
     upload_file_to_drive(csv_path, output_folder_id)
+    print(f"Tokens: {token_stats['calls']} calls, {token_stats['prompt_tokens']} in, "
+          f"{token_stats['completion_tokens']} out")
 
 if __name__ == "__main__":
     main()
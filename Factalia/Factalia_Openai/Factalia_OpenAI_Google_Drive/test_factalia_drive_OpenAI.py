@@ -0,0 +1,84 @@
+import io
+import time
+import threading
+import pytest
+
+# Lo script importa le librerie di Drive e OpenAI all'avvio: senza di esse la prova viene saltata
+for module in ('pdfplumber', 'openai', 'google.auth', 'googleapiclient'):
+    pytest.importorskip(module)
+
+import factalia_drive_OpenAI as drive
+
+# Elenco finto della cartella, diviso in due pagine collegate da nextPageToken
+LIST_PAGES = {
+    None: {
+        'files': [{'id': 'id-1', 'name': 'a.pdf'}, {'id': 'id-2', 'name': 'b.pdf'}, {'id': 'id-3', 'name': 'c.pdf'}],
+        'nextPageToken': 'page-2'
+    },
+    'page-2': {'files': [{'id': 'id-4', 'name': 'd.pdf'}, {'id': 'id-5', 'name': 'e.pdf'}]}
+}
+
+# Finto servizio di Drive: risponde a files().list(...).execute() con la pagina richiesta e registra i token
+class FakeDriveService:
+    def __init__(self):
+        self.page_tokens = []
+
+    def files(self):
+        return self
+
+    def list(self, q, fields, pageSize, pageToken=None):
+        self.page_tokens.append(pageToken)
+        page = LIST_PAGES[pageToken]
+        return type('Request', (), {'execute': lambda request: page})()
+
+
+def test_process_invoices_follows_pages_and_keeps_listing_order(monkeypatch):
+    service = FakeDriveService()
+
+    # I primi file dell'elenco sono i più lenti da scaricare: i download terminano in ordine inverso
+    def download_file(file_id, service_factory):
+        time.sleep(0.05 * (6 - int(file_id.split('-')[1])))
+        return io.BytesIO(file_id.encode('utf-8'))
+
+    monkeypatch.setattr(drive, 'extract_text_from_pdf', lambda pdf_file, prompt: [{'TOTAL': pdf_file.read().decode()}])
+
+    results = drive.process_invoices_from_drive(
+        'input-folder', 'output-folder', 'TOTAL: [valor]\n',
+        service_factory=lambda: service, download_file=download_file
+    )
+
+    assert service.page_tokens == [None, 'page-2']
+    assert [result['File'] for result in results] == ['a.pdf', 'b.pdf', 'c.pdf', 'd.pdf', 'e.pdf']
+    assert [result['TOTAL'] for result in results] == ['id-1', 'id-2', 'id-3', 'id-4', 'id-5']
+
+
+def test_downloads_in_memory_never_exceed_max_pending(monkeypatch):
+    monkeypatch.setattr(drive, 'MAX_PENDING_DOWNLOADS', 2)
+    lock = threading.Lock()
+    in_flight = {'current': 0, 'max': 0}
+
+    # Un PDF è in memoria dall'avvio del suo download alla fine della sua estrazione
+    def download_file(file_id, service_factory):
+        with lock:
+            in_flight['current'] += 1
+            in_flight['max'] = max(in_flight['max'], in_flight['current'])
+        return io.BytesIO(file_id.encode('utf-8'))
+
+    # L'estrazione è più lenta dei download: senza limite i PDF scaricati si accumulerebbero
+    def extract_text_from_pdf(pdf_file, prompt):
+        time.sleep(0.02)
+        total = pdf_file.read().decode()
+        with lock:
+            in_flight['current'] -= 1
+        return [{'TOTAL': total}]
+
+    monkeypatch.setattr(drive, 'extract_text_from_pdf', extract_text_from_pdf)
+    items = [{'id': f'id-{index}', 'name': f'{index}.pdf'} for index in range(10)]
+
+    results = drive.process_invoices_from_drive(
+        'input-folder', 'output-folder', 'TOTAL: [valor]\n',
+        list_files=lambda folder_id, service_factory: items, download_file=download_file
+    )
+
+    assert [result['TOTAL'] for result in results] == [item['id'] for item in items]
+    assert in_flight['max'] == 2
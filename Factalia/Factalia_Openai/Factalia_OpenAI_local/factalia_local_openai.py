@@ -1,31 +1,93 @@
 import os
+import sys
 import fitz  # PyMuPDF
 import openai
 import csv
 
+# Funzioni comuni a tutti gli script (hash, cache del testo e delle risposte, budget di token):
+# factalia_common.py, nella cartella Factalia
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import factalia_common
+from factalia_common import (
+    file_sha256, text_cache_key, text_cache_get, text_cache_put, text_cache_stats, llm_cache_key, llm_cache_get,
+    llm_cache_put, llm_cache_stats, estimate_tokens, fit_text_to_tokens
+)
+
 # Configura la tua chiave API di OpenAI
 openai.api_key = 'YOU_OPENAI_API_KEY'
 
+# Modello, finestra di contesto e token riservati alla risposta: il testo della fattura viene ridotto
+# per rientrare in MAX_CONTEXT_TOKENS - MAX_RESPONSE_TOKENS insieme al prompt (come nello script di Drive)
+MODEL = "gpt-3.5-turbo"
+MAX_CONTEXT_TOKENS = 4096
+MAX_RESPONSE_TOKENS = 500
+SYSTEM_MESSAGE = "Sei un assistente utile che estrae informazioni specifiche dal testo."
+
+# Cartella locale con i PDF e file CSV dei risultati (le cache SQLite vengono create accanto al CSV)
+FOLDER_PATH = '/home/robin/Desktop/Facturalia_3/bill'
+CSV_PATH = '/home/robin/Desktop/Facturalia_3/csv/data3.csv'
+
+# Cache persistente del testo estratto dai PDF (SQLite, compresso con zlib): cambiando il prompt il PDF non si rilegge
+TEXT_CACHE_PATH = os.path.join(os.path.dirname(CSV_PATH), 'text_cache.sqlite')
+TEXT_CACHE_MAX_BYTES = 500 * 1024 * 1024
+TEXT_CACHE_ENABLED = True  # False per rileggere sempre i PDF
+
+# Cache persistente delle risposte di OpenAI (SQLite), indirizzata dal contenuto della richiesta
+LLM_CACHE_PATH = os.path.join(os.path.dirname(CSV_PATH), 'llm_cache.sqlite')
+LLM_CACHE_MAX_BYTES = 200 * 1024 * 1024
+LLM_CACHE_ENABLED = True  # False per ignorare la cache e interrogare sempre OpenAI
+
+# Le cache sono quelle di factalia_common, con i percorsi e le dimensioni di questo script
+factalia_common.configure(
+    text_cache_path=TEXT_CACHE_PATH,
+    text_cache_max_bytes=TEXT_CACHE_MAX_BYTES,
+    text_cache_enabled=TEXT_CACHE_ENABLED,
+    llm_cache_path=LLM_CACHE_PATH,
+    llm_cache_max_bytes=LLM_CACHE_MAX_BYTES,
+    llm_cache_enabled=LLM_CACHE_ENABLED
+)
+
 def extract_text_from_pdf(pdf_path):
-    """Estrae il testo da un file PDF."""
-    doc = fitz.open(pdf_path)
-    text = ""
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        text += page.get_text()
-    return text
+    """Estrae il testo da un file PDF (dalla cache di testo se il PDF è già stato letto con le stesse impostazioni)."""
+    cache_key = text_cache_key(file_sha256(pdf_path), 'pymupdf', {'version': fitz.VersionBind})
+    page_texts = text_cache_get(cache_key)
+    if page_texts is not None:
+        return "".join(page_texts)
+
+    page_texts = []
+    with fitz.open(pdf_path) as doc:
+        for page_num in range(len(doc)):
+            page = doc.load_page(page_num)
+            page_texts.append(page.get_text())
+    text_cache_put(cache_key, page_texts)
+    return "".join(page_texts)
+
+def get_text_budget(prompt):
+    """Calcola i token disponibili per il testo della fattura (contesto meno risposta, messaggio di sistema,
+    prompt e formato dei messaggi)."""
+    return (MAX_CONTEXT_TOKENS - MAX_RESPONSE_TOKENS - estimate_tokens(SYSTEM_MESSAGE, MODEL)
+            - estimate_tokens(prompt + "\n\n", MODEL) - 16)
 
 def get_info_from_openai(text, prompt):
-    """Interroga il modello GPT-3.5-turbo per estrarre informazioni."""
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "Sei un assistente utile che estrae informazioni specifiche dal testo."},
+    """Interroga il modello GPT-3.5-turbo per estrarre informazioni (consultando prima la cache)."""
+    text = fit_text_to_tokens(text, get_text_budget(prompt), MODEL)
+    request = {
+        'model': MODEL,
+        'messages': [
+            {"role": "system", "content": SYSTEM_MESSAGE},
             {"role": "user", "content": prompt + "\n\n" + text}
         ],
-        max_tokens=500
-    )
-    return response.choices[0].message['content'].strip()
+        'max_tokens': MAX_RESPONSE_TOKENS
+    }
+    cache_key = llm_cache_key(request)
+    cached_response = llm_cache_get(cache_key)
+    if cached_response is not None:
+        return cached_response
+
+    response = openai.ChatCompletion.create(**request)
+    response_text = response.choices[0].message['content'].strip()
+    llm_cache_put(cache_key, response_text)
+    return response_text
 
 def parse_info(info):
     """Parses the extracted information into a dictionary."""
@@ -69,8 +131,8 @@ def save_results_to_csv(results, csv_path):
     print(f"Risultati salvati in {csv_path}")
 
 def main():
-    folder_path = '/home/robin/Desktop/Facturalia_3/bill'  # Percorso della tua cartella locale
-    csv_path = '/home/robin/Desktop/Facturalia_3/csv/data3.csv'  # Percorso del file CSV
+    folder_path = FOLDER_PATH  # Percorso della tua cartella locale
+    csv_path = CSV_PATH  # Percorso del file CSV
 
     prompt = ("Extrae la siguiente información del texto proporcionado:\n"
               "- número de factura\n"
@@ -105,6 +167,10 @@ def main():
 
     results = process_pdfs_in_folder(folder_path, prompt)
     save_results_to_csv(results, csv_path)
+    print(f"Cache LLM: {llm_cache_stats['hits']} hit, {llm_cache_stats['misses']} miss, "
+          f"{llm_cache_stats['evictions']} voci eliminate")
+    print(f"Cache testo: {text_cache_stats['hits']} hit, {text_cache_stats['misses']} miss, "
+          f"{text_cache_stats['evictions']} voci eliminate")
 
 if __name__ == "__main__":
     main()
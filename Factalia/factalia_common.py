@@ -0,0 +1,321 @@
+# Funzioni comuni a tutti gli script di Factalia: hash dei PDF, cache SQLite del testo e delle risposte del LLM,
+# budget di token, sessione e risposte in streaming di Ollama, schema JSON dei campi.
+# Gli script (o i moduli ocr_pipeline e invoice_common) passano le impostazioni a configure.
+import os
+import re
+import json
+import time
+import math
+import hashlib
+import sqlite3
+import textwrap
+import threading
+import zlib
+from contextlib import closing
+import requests
+from requests.adapters import HTTPAdapter
+
+# Funzione per calcolare l'hash SHA-256 del contenuto di un file
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Funzione per eliminare le voci meno usate di una tabella di cache finché non si torna sotto la dimensione massima
+def evict_cache_entries(conn, table, max_bytes, stats):
+    total_size = conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()[0]
+    if total_size <= max_bytes:
+        return
+    for old_key, old_size in conn.execute(f"SELECT key, size FROM {table} ORDER BY last_used").fetchall():
+        if total_size <= max_bytes:
+            break
+        conn.execute(f"DELETE FROM {table} WHERE key = ?", (old_key,))
+        total_size -= old_size
+        stats['evictions'] += 1
+
+# Cache persistente del testo estratto dai PDF (SQLite, compresso con zlib)
+text_cache_lock = threading.Lock()
+text_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+# Funzione per calcolare la chiave del testo estratto: hash del PDF + estrattore + impostazioni che cambiano il testo
+def text_cache_key(file_hash, extractor, settings):
+    raw = json.dumps({'file': file_hash, 'extractor': extractor, 'settings': settings}, sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+# Funzione per aprire il database della cache di testo (lo crea se non esiste)
+def open_text_cache():
+    os.makedirs(os.path.dirname(text_cache_path) or '.', exist_ok=True)
+    conn = sqlite3.connect(text_cache_path, timeout=30)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS text_cache ("
+        "key TEXT PRIMARY KEY, pages BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS text_cache_last_used ON text_cache (last_used)")
+    return conn
+
+# Funzione per leggere dalla cache le pagine di un PDF (None se mancano o se la cache è disattivata)
+def text_cache_get(key):
+    if not text_cache_enabled:
+        return None
+    with text_cache_lock, closing(open_text_cache()) as conn, conn:
+        row = conn.execute("SELECT pages FROM text_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            text_cache_stats['misses'] += 1
+            return None
+        conn.execute("UPDATE text_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        text_cache_stats['hits'] += 1
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+# Funzione per salvare in cache le pagine di un PDF, eliminando le voci meno usate oltre la dimensione massima
+def text_cache_put(key, pages):
+    if not text_cache_enabled:
+        return
+    data = zlib.compress(json.dumps(pages, ensure_ascii=False).encode('utf-8'))
+    with text_cache_lock, closing(open_text_cache()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO text_cache (key, pages, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, data, len(data), time.time())
+        )
+        evict_cache_entries(conn, 'text_cache', text_cache_max_bytes, text_cache_stats)
+
+# Cache persistente delle risposte del LLM (SQLite), indirizzata dal contenuto della richiesta
+llm_cache_lock = threading.Lock()
+llm_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+# Funzione per calcolare la chiave di cache: hash di modello + prompt completo + opzioni di generazione
+# (lo streaming non cambia la risposta e non fa parte della chiave)
+def llm_cache_key(request):
+    request = {key: value for key, value in request.items() if key != 'stream'}
+    raw = json.dumps(request, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+# Funzione per aprire il database della cache delle risposte (lo crea se non esiste)
+def open_llm_cache():
+    os.makedirs(os.path.dirname(llm_cache_path) or '.', exist_ok=True)
+    conn = sqlite3.connect(llm_cache_path, timeout=30)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS llm_cache ("
+        "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used)")
+    return conn
+
+# Funzione per leggere una risposta dalla cache (None se manca o se la cache è disattivata)
+def llm_cache_get(key):
+    if not llm_cache_enabled:
+        return None
+    with llm_cache_lock, closing(open_llm_cache()) as conn, conn:
+        row = conn.execute("SELECT response FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            llm_cache_stats['misses'] += 1
+            return None
+        conn.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        llm_cache_stats['hits'] += 1
+        return row[0]
+
+# Funzione per salvare una risposta in cache, eliminando le meno usate oltre la dimensione massima
+def llm_cache_put(key, response):
+    if not llm_cache_enabled:
+        return
+    size = len(response.encode('utf-8'))
+    with llm_cache_lock, closing(open_llm_cache()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, response, size, time.time())
+        )
+        evict_cache_entries(conn, 'llm_cache', llm_cache_max_bytes, llm_cache_stats)
+
+# Caratteri per token approssimativi di ogni modello con fatture in spagnolo
+# (si usa il valore osservato nelle risposte di Ollama quando è più basso)
+CHARS_PER_TOKEN = {'llama3': 3.2, 'gemma2': 3.4, 'gpt-3.5-turbo': 3.6}
+
+# Token di input e di output delle chiamate al LLM (conteggi restituiti da Ollama)
+token_stats_lock = threading.Lock()
+token_stats = {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'prompt_chars': 0}
+
+# Funzione per ottenere i caratteri per token del modello: il valore di CHARS_PER_TOKEN o quello osservato
+# nelle chiamate precedenti se più basso (così il budget non viene superato)
+def get_chars_per_token(model):
+    chars_per_token = CHARS_PER_TOKEN.get(model, 3.0)
+    with token_stats_lock:
+        if token_stats['prompt_tokens'] >= 1000:
+            chars_per_token = min(chars_per_token, token_stats['prompt_chars'] / token_stats['prompt_tokens'])
+    return chars_per_token
+
+# Funzione per stimare i token di un testo con il modello indicato (di default llm_model)
+def estimate_tokens(text, model=None):
+    return math.ceil(len(text) / get_chars_per_token(model or llm_model))
+
+# Funzione per dividere il testo in righe di al massimo width caratteri (le righe troppo lunghe tra due parole)
+def split_lines(text, width):
+    return [
+        piece for line in text.splitlines()
+        for piece in (textwrap.wrap(line, width) if len(line) > width else [line])
+    ]
+
+# Funzione per ridurre un testo a un budget di token senza spezzare le righe
+# Se non entra per intero si tengono le prime righe e le ultime (dove di solito ci sono i totali)
+def fit_text_to_tokens(text, max_tokens, model=None, head_share=0.6):
+    if estimate_tokens(text, model) <= max_tokens:
+        return text
+    max_chars = int(max(max_tokens, 0) * get_chars_per_token(model or llm_model))
+    lines = split_lines(text, max(20, min(200, max_chars // 4)))
+
+    head, used_chars = [], 0
+    for line in lines:
+        if used_chars + len(line) + 1 > max_chars * head_share:
+            break
+        head.append(line)
+        used_chars += len(line) + 1
+
+    tail = []
+    for line in reversed(lines[len(head):]):
+        if used_chars + len(line) + 1 > max_chars - len('[...]\n'):
+            break
+        tail.insert(0, line)
+        used_chars += len(line) + 1
+    return '\n'.join(head + ['[...]'] + tail)
+
+# Funzione per comporre un prompt riducendo il testo in modo che il totale non superi max_tokens
+# (build_prompt riceve il testo e restituisce il prompt completo)
+def fit_prompt(build_prompt, text, max_tokens, model=None):
+    overhead = estimate_tokens(build_prompt(''), model)
+    return build_prompt(fit_text_to_tokens(text, max_tokens - overhead, model))
+
+# Funzione per registrare e mostrare i token di input e di output di una chiamata a Ollama
+def record_token_usage(prompt, usage):
+    prompt_tokens = usage.get('prompt_eval_count', 0)
+    completion_tokens = usage.get('eval_count', 0)
+    with token_stats_lock:
+        token_stats['calls'] += 1
+        token_stats['completion_tokens'] += completion_tokens
+        if prompt_tokens:  # Senza conteggio (risposta interrotta prima della fine) non si usa per la calibrazione
+            token_stats['prompt_tokens'] += prompt_tokens
+            token_stats['prompt_chars'] += len(prompt)
+    estimated = '' if prompt_tokens else f" (estimados {estimate_tokens(prompt)})"
+    print(f"Tokens: {prompt_tokens or '-'} de entrada{estimated}, {completion_tokens} de salida")
+
+# Sessione HTTP condivisa verso Ollama: riutilizza le connessioni (keep-alive) tra le richieste
+ollama_session = None
+ollama_session_lock = threading.Lock()
+
+# Funzione per ottenere la sessione HTTP condivisa, con un pool di connessioni pari alle richieste parallele
+def get_ollama_session():
+    global ollama_session
+    with ollama_session_lock:
+        if ollama_session is None:
+            ollama_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=ollama_num_parallel)
+            ollama_session.mount('http://', adapter)
+            ollama_session.mount('https://', adapter)
+    return ollama_session
+
+# Funzione per leggere le coppie "campo": "valore" già complete da una risposta JSON parziale
+def parse_fields_incremental(partial_text, fields):
+    found = {}
+    pair_pattern = r'"((?:[^"\\]|\\.)*)"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+(?:\.\d+)?(?=\s*[,}])|null(?=\s*[,}]))'
+    for match in re.finditer(pair_pattern, partial_text):
+        key = json.loads(f'"{match.group(1)}"')
+        if key in fields:
+            value = json.loads(match.group(2))
+            found[key] = '' if value is None else str(value)
+    return found
+
+# Funzione per leggere la risposta in streaming (NDJSON) e interrompere la generazione appena arrivano tutti i campi
+# In usage restano i token: ogni frammento è un token e l'ultimo contiene i conteggi di Ollama
+def read_stream_until_fields(response, fields, usage=None):
+    usage = {} if usage is None else usage
+    chunks = []
+    try:
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            chunks.append(chunk.get('response', ''))
+            usage['eval_count'] = len(chunks)
+            if chunk.get('done'):
+                usage['prompt_eval_count'] = chunk.get('prompt_eval_count', 0)
+                usage['eval_count'] = chunk.get('eval_count', len(chunks))
+                break
+            found = parse_fields_incremental(''.join(chunks), fields)
+            if len(found) == len(fields):
+                # Chiudendo la connessione Ollama annulla il resto della generazione
+                return json.dumps(found, ensure_ascii=False)
+    finally:
+        response.close()
+    return ''.join(chunks)
+
+# Funzione per controllare la risposta di Ollama: un errore del server (modello mancante, memoria esaurita...)
+# viene sollevato come requests.HTTPError, così il documento non viene registrato con i campi vuoti
+# (resta con stato 'error' nel manifest o fuori dal journal e viene ripreso)
+def check_ollama_response(response):
+    if response.status_code != 200:
+        message = f"Ollama respondió {response.status_code}: {response.text}"
+        response.close()
+        raise requests.HTTPError(message, response=response)
+
+# Funzione per costruire lo schema JSON della risposta a partire dall'elenco dei campi
+def build_fields_schema(fields):
+    return {
+        "type": "object",
+        "properties": {field: {"type": "string"} for field in fields},
+        "required": list(fields),
+        "additionalProperties": False
+    }
+
+# Funzione per validare la risposta strutturata: deve essere un oggetto JSON con esattamente i campi richiesti
+def validate_fields_response(response, fields):
+    data = json.loads(response)
+    if not isinstance(data, dict):
+        raise ValueError("la respuesta no es un objeto JSON")
+    missing = [field for field in fields if field not in data]
+    unexpected = [key for key in data if key not in fields]
+    if missing or unexpected:
+        raise ValueError(f"campos ausentes {missing}, campos no previstos {unexpected}")
+
+    values = {}
+    for field in fields:
+        value = data[field]
+        if value is None:
+            value = ''
+        if not isinstance(value, (str, int, float)):
+            raise ValueError(f"valor no válido para '{field}': {value!r}")
+        values[field] = str(value).strip()
+    return values
+
+# Cache del testo estratto dai PDF: percorso, dimensione massima e attivazione (gli script la mettono accanto al CSV)
+text_cache_path = 'text_cache.sqlite'
+text_cache_max_bytes = 500 * 1024 * 1024
+text_cache_enabled = True
+
+# Cache delle risposte del LLM: percorso, dimensione massima e attivazione (gli script la mettono accanto al CSV)
+llm_cache_path = 'llm_cache.sqlite'
+llm_cache_max_bytes = 200 * 1024 * 1024
+llm_cache_enabled = True
+
+# Modello del LLM (per la stima dei token e nelle richieste a Ollama)
+llm_model = 'llama3'
+
+# Richieste simultanee a Ollama: deve coincidere con OLLAMA_NUM_PARALLEL del server
+ollama_num_parallel = int(os.environ.get('OLLAMA_NUM_PARALLEL', 4))
+ollama_slots = threading.BoundedSemaphore(ollama_num_parallel)
+
+# Impostazioni che si possono cambiare con configure (ocr_pipeline e invoice_common le inoltrano dal loro configure)
+SETTINGS = {
+    'text_cache_path', 'text_cache_max_bytes', 'text_cache_enabled',
+    'llm_cache_path', 'llm_cache_max_bytes', 'llm_cache_enabled',
+    'llm_model', 'ollama_num_parallel'
+}
+
+# Funzione per cambiare le impostazioni del modulo (cache, modello, richieste parallele a Ollama)
+# Un nome sconosciuto solleva ValueError
+def configure(**settings):
+    global ollama_slots
+    unknown = [name for name in settings if name not in SETTINGS]
+    if unknown:
+        raise ValueError(f"Impostazioni sconosciute: {unknown}")
+    globals().update(settings)
+    if 'ollama_num_parallel' in settings:
+        ollama_slots = threading.BoundedSemaphore(ollama_num_parallel)